@@ -0,0 +1,262 @@
+"""
+Times every stage of the invoicing pipeline on synthetic books of increasing size and
+prints the results as JSON, e.g.
+
+    python -m benchmarks.run --sizes 10 100 1000 --output bench.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import date
+from datetime import datetime
+from io import BytesIO
+
+import data_models as models
+import utils
+from benchmarks.synthetic import write_synthetic_book
+from benchmarks.synthetic import write_synthetic_water_report
+from config import AppConfig
+from config import BusinessEntityParams
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+DEFAULT_SIZES = [10, 100, 1_000, 10_000, 50_000]
+
+COMPANY = BusinessEntityParams(
+    business_name="Benchmark Parks LLC",
+    business_address_1="1 Main Street",
+    business_address_2="Springfield, IL 62701",
+    business_contact_phone="555-0100",
+    business_contact_email="billing@example.com",
+)
+PROPERTY = models.Property(
+    property_code="BEN",
+    street_address="Benchmark Road",
+    city_state_zip="Springfield, IL 62701",
+)
+STATEMENT_DATE = date(2024, 9, 1)
+
+
+class StageTimer:
+    """
+    Collects wall time, item counts and peak traced memory of pipeline stages. The
+    peak growth is the peak less the memory already traced when the stage started,
+    i.e. what the stage itself needed.
+    """
+
+    def __init__(self, trace_memory: bool = True):
+        self.trace_memory = trace_memory
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name: str, items: int):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            traced_at_start = tracemalloc.get_traced_memory()[0]
+        result = {"items": items}
+        start = time.perf_counter()
+        yield result
+        seconds = time.perf_counter() - start
+        result["seconds"] = round(seconds, 6)
+        result["items_per_second"] = round(result["items"] / seconds, 2)
+        if self.trace_memory:
+            result["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+            result["peak_memory_growth_bytes"] = (
+                result["peak_memory_bytes"] - traced_at_start
+            )
+        result["max_rss_bytes"] = max_rss_bytes()
+        self.stages[name] = result
+
+
+def max_rss_bytes() -> int | None:
+    """High-water mark of the resident memory of this process so far"""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def benchmark_size(
+    lots: int,
+    work_dir: str,
+    template_path: str,
+    workers: int = 1,
+    excel_engine: str | None = None,
+    render_engine: str = "openpyxl",
+    trace_memory: bool = True,
+    seed: int = 0,
+    chunk_size: int = 500,
+) -> dict:
+    """
+    Runs the pipeline over a synthetic book of the given size: end to end into a .zip
+    file, once streamed chunk_size lots at a time and once all at once, and then
+    stage by stage
+    """
+    book_path = os.path.join(work_dir, f"book_{lots}.xlsx")
+    water_path = os.path.join(work_dir, f"water_{lots}.xlsx")
+    export_path = os.path.join(work_dir, f"invoices_{lots}") + os.sep
+    os.makedirs(export_path, exist_ok=True)
+
+    write_synthetic_book(book_path, lots, seed=seed)
+    write_synthetic_water_report(water_path, lots, seed=seed)
+
+    timer = StageTimer(trace_memory=trace_memory)
+
+    for name, chunks in (("stream_zip", chunk_size), ("end_to_end_zip", None)):
+        with (
+            timer.stage(name, lots) as result,
+            open(book_path, "rb") as book,
+            open(water_path, "rb") as waters,
+            open(os.path.join(work_dir, f"{name}_{lots}.zip"), "wb") as zip_file,
+        ):
+            result["invoices"] = len(
+                utils.generate_invoice_from_user_inputs(
+                    book=book,
+                    waters=waters,
+                    statement_date=STATEMENT_DATE,
+                    prop=PROPERTY.model_dump(),
+                    template_path=template_path,
+                    export_path=None,
+                    company=COMPANY,
+                    workers=workers,
+                    excel_engine=excel_engine,
+                    zip_buffer=zip_file,
+                    render_engine=render_engine,
+                    chunk_size=chunks,
+                )
+            )
+            result["chunk_size"] = chunks
+            result["bytes_written"] = zip_file.tell()
+
+    with timer.stage("ingest_book", lots), open(book_path, "rb") as book:
+        book_df = utils.ingest_bookkeeping_excel(book, engine=excel_engine)
+
+    with timer.stage("ingest_water", lots), open(water_path, "rb") as waters:
+        water_df = utils.ingest_water_meter_readings(waters, engine=excel_engine)
+
+    with timer.stage("water_objects", lots):
+        water_report = utils.validate_water_usage_report(water_df, STATEMENT_DATE)
+
+    with timer.stage("serialize", lots):
+        input_data = utils.serialize_invoice_inputs_from_book_frame(
+            company=COMPANY,
+            statement_date=STATEMENT_DATE,
+            property_code=PROPERTY.property_code,
+            street_address_base=PROPERTY.street_address,
+            csz_address=PROPERTY.city_state_zip,
+            book_df=book_df,
+            waters=water_report,
+        )
+
+    with timer.stage("invoice_models", len(input_data)):
+        invoice_parsed = models.validate_invoice_cells(input_data)
+
+    with timer.stage("generate_invoices", len(invoice_parsed)) as result:
+        file_paths = utils.generate_invoices(
+            template_path=template_path,
+            input_data=invoice_parsed,
+            export_path=export_path,
+            workers=workers,
+            render_engine=render_engine,
+        )
+        result["bytes_written"] = sum(os.path.getsize(p) for p in file_paths)
+
+    with timer.stage("zip", len(file_paths)) as result:
+        zip_buffer = utils.zip_invoice_files(export_path)
+        result["bytes_written"] = zip_buffer.getbuffer().nbytes
+        zip_buffer.close()
+
+    with timer.stage("generate_invoice_zip", len(invoice_parsed)) as result:
+        zip_buffer = BytesIO()
+        utils.generate_invoice_zip(
+            template_path=template_path,
+            input_data=invoice_parsed,
+            zip_buffer=zip_buffer,
+            workers=workers,
+            render_engine=render_engine,
+        )
+        result["bytes_written"] = zip_buffer.getbuffer().nbytes
+        zip_buffer.close()
+
+    return {"lots": lots, "invoices": len(file_paths), "stages": timer.stages}
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--excel-engine", default=None)
+    parser.add_argument("--render-engine", default="openpyxl")
+    parser.add_argument("--template-path", default=AppConfig().template_path)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=500,
+        help="lots per chunk of the streamed end-to-end run",
+    )
+    parser.add_argument(
+        "--no-trace-memory",
+        action="store_true",
+        help="skip tracemalloc, which slows down the timed stages several times",
+    )
+    parser.add_argument("--output", help="JSON file to write instead of stdout")
+    args = parser.parse_args(argv)
+
+    trace_memory = not args.no_trace_memory
+    if trace_memory:
+        tracemalloc.start()
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for lots in args.sizes:
+            results.append(
+                benchmark_size(
+                    lots,
+                    work_dir=work_dir,
+                    template_path=args.template_path,
+                    workers=args.workers,
+                    excel_engine=args.excel_engine,
+                    render_engine=args.render_engine,
+                    trace_memory=trace_memory,
+                    seed=args.seed,
+                    chunk_size=args.chunk_size,
+                )
+            )
+
+    report = {
+        "meta": {
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "workers": args.workers,
+            "excel_engine": args.excel_engine,
+            "render_engine": args.render_engine,
+            "trace_memory": trace_memory,
+            "chunk_size": args.chunk_size,
+        },
+        "results": results,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""Synthetic bookkeeping books and water reports for benchmarking the pipeline"""
+
+import random
+from datetime import datetime
+
+from dateutil.relativedelta import relativedelta
+from openpyxl import Workbook
+from openpyxl import load_workbook
+
+# Column labels of a bookkeeping sheet, in order after the lot column. The columns
+# ingest_bookkeeping_excel drops (positions 1, 9, 15, 23 and 25) are filler here.
+BOOK_COLUMNS = [
+    "Tenant",
+    "Home type",
+    "Starting balance",
+    "Monthly due",
+    "Paid on time",
+    "Paid past due",
+    "Late fee accrued",
+    "Total carried over",
+    "Ending balance",
+    "Notes",
+    "Rent",
+    "Storage",
+    "Water",
+    "Other",
+    "New charges",
+    "Memo",
+    "Payment on time 1",
+    "Payment on time 2",
+    "Payment on time 3",
+    "Payment overdue 1",
+    "Payment overdue 2",
+    "Payment overdue 3",
+    "Payment overdue 4",
+    "Payment total",
+    "Late fee",
+    "Check #",
+    "Carry over",
+]
+
+
+def _book_row(rng: random.Random, lot: int) -> list:
+    rent = rng.choice([425.0, 450.0, 475.0, 500.0])
+    storage = rng.choice([None, None, None, 25.0, 40.0])
+    water = round(rng.uniform(8, 60), 2)
+    other = rng.choice([None] * 9 + [rng.choice([15.0, 30.0])])
+    starting_balance = rng.choice([0.0, 0.0, 0.0, round(rng.uniform(-50, 400), 2)])
+    monthly_due = round(rent + (storage or 0) + water + (other or 0), 2)
+    paid_on_time = rng.choice([monthly_due, monthly_due, 0.0, None])
+    paid_past_due = rng.choice([None, None, None, round(rng.uniform(0, 300), 2)])
+    late_fee = rng.choice([None, None, None, round(monthly_due * 0.05, 2)])
+    carried_over = rng.choice([0.0, 0.0, round(rng.uniform(-40, 300), 2)])
+    ending_balance = rng.choice([0.0, 0.0, round(rng.uniform(-40, 600), 2)])
+    new_charges = 0.0 if rng.random() < 0.03 and not ending_balance else monthly_due
+
+    return [
+        lot,
+        f"Tenant {lot}",
+        rng.choice(["SW", "DW"]),
+        starting_balance,
+        monthly_due,
+        paid_on_time,
+        paid_past_due,
+        late_fee,
+        carried_over,
+        ending_balance,
+        None,
+        rent,
+        storage,
+        water,
+        other,
+        new_charges,
+        None,
+        paid_on_time,
+        None,
+        None,
+        paid_past_due,
+        None,
+        None,
+        None,
+        (paid_on_time or 0) + (paid_past_due or 0),
+        late_fee,
+        rng.choice([None, 1001 + lot]),
+        carried_over,
+    ]
+
+
+def write_synthetic_book(
+    path: str,
+    lots: int,
+    sheet_names: tuple[str, ...] = ("Sheet1",),
+    seed: int = 0,
+) -> None:
+    """Writes a bookkeeping workbook in the layout read by ingest_bookkeeping_excel
+
+    Each sheet has a title row, a blank row, the column labels on the third row and
+    one row per lot numbered 1 to lots.
+
+    Args:
+        path (str): output .xlsx file
+        lots (int): number of lots per sheet
+        sheet_names (tuple[str, ...], optional):
+            Worksheets to write, e.g. one per month. Defaults to ("Sheet1",).
+        seed (int, optional): seed of the random amounts. Defaults to 0.
+    """
+    rng = random.Random(seed)
+    wb = Workbook(write_only=True)
+    for sheet_name in sheet_names:
+        ws = wb.create_sheet(sheet_name)
+        ws.append([f"Rent roll {sheet_name}"])
+        ws.append([])
+        ws.append(["Lot"] + BOOK_COLUMNS)
+        for lot in range(1, lots + 1):
+            ws.append(_book_row(rng, lot))
+    wb.save(path)
+
+
+def write_synthetic_water_report(
+    path: str,
+    lots: int,
+    current_date: datetime = datetime(2024, 8, 1),
+    template_path: str = "template/water_report_template.xlsx",
+    seed: int = 0,
+) -> None:
+    """Writes a water report with one meter per lot, laid out like the template
+
+    The heading rows of template_path are kept and its readings are replaced.
+
+    Args:
+        path (str): output .xlsx file
+        lots (int): number of lots, numbered 1 to lots
+        current_date (datetime, optional):
+            Date of the current readings; previous readings are a month earlier.
+            Defaults to datetime(2024, 8, 1).
+        template_path (str, optional):
+            Water report template. Defaults to "template/water_report_template.xlsx".
+        seed (int, optional): seed of the random readings. Defaults to 0.
+    """
+    rng = random.Random(seed)
+    template = load_workbook(template_path)
+    template_ws = template.active
+    title = template_ws.cell(1, 1).value
+    labels = [c.value for c in template_ws[2]]
+    labels[3] = current_date
+    labels[4] = current_date - relativedelta(months=1)
+    template.close()
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(template_ws.title)
+    ws.append([title])
+    ws.append(labels)
+    for lot in range(1, lots + 1):
+        row = lot + 2
+        previous_reading = rng.randrange(100_000, 900_000, 10)
+        current_reading = previous_reading + rng.randrange(0, 6_000, 10)
+        ws.append(
+            [
+                lot,
+                None,
+                40_000_000 + lot,
+                current_reading,
+                previous_reading,
+                f"=D{row}-E{row}",
+                None,
+            ]
+        )
+    wb.save(path)
@@ -0,0 +1,378 @@
+r"""
+Generates the invoices of a property from a bookkeeping book without the Streamlit
+app, e.g.
+
+    python cli.py --book book.xlsx --water water.xlsx --property ABC \
+        --statement-date 2025-01 --output invoices.zip
+
+The invoices are written into a .zip file if --output ends with .zip, as the sheets of
+a single workbook if it ends with .xlsx, or saved in the --output directory otherwise.
+With --batch, every property of a JSON mapping is invoiced in one run into a single
+.zip file with a folder per property, e.g.
+
+    python cli.py --batch month_end.json --book book.xlsx \
+        --statement-date 2025-01 --output invoices.zip
+"""
+
+import argparse
+import cProfile
+import json
+import os
+import sys
+from contextlib import ExitStack
+from datetime import date
+from datetime import datetime
+
+from pydantic import ValidationError
+
+import instrumentation
+import utils
+from config import AppConfig
+from config import BusinessEntityParams
+from invoice_ledger import InvoiceLedger
+from rendering import RENDER_ENGINES
+from rendering import InvoiceRenderError
+from sheet_cache import SheetCache
+from water_store import WaterReadingStore
+
+
+def parse_statement_date(value: str) -> date:
+    """Parses YYYY-MM or YYYY-MM-DD into the first of that month"""
+    for fmt in ("%Y-%m", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, fmt).date().replace(day=1)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError(f"expected YYYY-MM or YYYY-MM-DD, got {value!r}")
+
+
+def find_property(
+    property_code: str,
+    street_address: str | None = None,
+    city_state_zip: str | None = None,
+) -> dict:
+    """
+    Looks the property up in template/properties.csv; the address given on the command
+    line takes precedence and is enough on its own if the property is not listed.
+    """
+    prop = {"property_code": property_code}
+    if street_address is None or city_state_zip is None:
+        prop = next(
+            (
+                p
+                for p in utils.get_properties() or []
+                if p["property_code"] == property_code
+            ),
+            prop,
+        )
+    if street_address is not None:
+        prop["street_address"] = street_address
+    if city_state_zip is not None:
+        prop["city_state_zip"] = city_state_zip
+    return prop
+
+
+def error_message(error: Exception) -> str:
+    """One line describing why a run failed, e.g. the settings missing from .env"""
+    if isinstance(error, ValidationError):
+        fields = ", ".join(".".join(map(str, e["loc"])) for e in error.errors())
+        return f"{error.title}: missing or invalid {fields}"
+    return str(error).splitlines()[0] if str(error) else repr(error)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    app_config = AppConfig()
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__.strip().split("\n", 1)[1],
+    )
+    parser.add_argument(
+        "--batch",
+        help="JSON file mapping property codes to their book, sheet and water report",
+    )
+    parser.add_argument("--book", help="bookkeeping .xlsx file")
+    parser.add_argument(
+        "--sheet", help="worksheet of the book to invoice (defaults to the last one)"
+    )
+    parser.add_argument(
+        "--lots",
+        type=int,
+        nargs="+",
+        help="lot numbers to invoice (defaults to every lot of the sheet)",
+    )
+    parser.add_argument("--water", help="water report .xlsx file (optional)")
+    parser.add_argument(
+        "--property",
+        dest="property_code",
+        help="property code, as listed in template/properties.csv",
+    )
+    parser.add_argument("--street-address", help="overrides the listed street")
+    parser.add_argument("--city-state-zip", help="overrides the listed city line")
+    parser.add_argument(
+        "--statement-date",
+        required=True,
+        type=parse_statement_date,
+        help="statement month, YYYY-MM",
+    )
+    parser.add_argument(
+        "--output",
+        required=True,
+        help=".zip file, .xlsx workbook with a sheet per invoice or directory to write to",
+    )
+    parser.add_argument("--template-path", default=app_config.template_path)
+    parser.add_argument("--workers", type=int, default=app_config.render_workers)
+    parser.add_argument(
+        "--render-engine",
+        choices=list(RENDER_ENGINES),
+        default=app_config.render_engine,
+        help="xml patches the template's sheet XML instead of going through openpyxl",
+    )
+    parser.add_argument("--excel-engine", default=app_config.excel_engine)
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=app_config.stream_chunk_lots,
+        help="stream the lots into a .zip --output this many at a time, in constant "
+        "memory (ignored with --batch)",
+    )
+    parser.add_argument(
+        "--water-store",
+        default=app_config.water_store_path,
+        help="SQLite file to record the water readings in and take missing "
+        "previous readings from",
+    )
+    parser.add_argument(
+        "--ledger",
+        default=app_config.invoice_ledger_path,
+        help="SQLite file to record the invoice data in",
+    )
+    parser.add_argument(
+        "--sheet-cache",
+        default=app_config.sheet_cache_path,
+        help="directory to keep the parsed books and water reports in, so that "
+        "files read before are not parsed again",
+    )
+    parser.add_argument(
+        "--sheet-cache-max-bytes",
+        type=int,
+        default=app_config.sheet_cache_max_bytes,
+        help="size above which the least recently used --sheet-cache entries are "
+        "removed",
+    )
+    parser.add_argument(
+        "--metrics-log",
+        default=app_config.metrics_log_path,
+        help="file to append the run metrics to as a JSON line",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only re-render the invoices of an --output directory whose data changed",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="print the top functions of the run by cumulative time",
+    )
+    return parser
+
+
+def load_batch(batch_path: str, default_book: str | None) -> dict[str, dict]:
+    """
+    Reads a --batch file, e.g.
+
+        {"ABC": {"sheet": "Jan 2025", "water": "abc_water.xlsx"},
+         "XYZ": {"book": "xyz.xlsx", "water": "xyz_water.xlsx"}}
+
+    Entries without a "book" use default_book; "sheet" defaults to the last worksheet,
+    "water" is optional and "lots" lists the lot numbers to invoice, if not all.
+    Relative paths are relative to the batch file.
+    """
+    with open(batch_path) as f:
+        entries = json.load(f)
+
+    base_dir = os.path.dirname(os.path.abspath(batch_path))
+    batch = {}
+    for property_code, entry in entries.items():
+        book = entry.get("book", default_book)
+        if book is None:
+            raise ValueError(f"{property_code}: no book given and no --book default")
+        water = entry.get("water")
+        batch[property_code] = {
+            "book": os.path.join(base_dir, book) if "book" in entry else book,
+            "sheet_name": entry.get("sheet"),
+            "lots": entry.get("lots"),
+            "waters": os.path.join(base_dir, water) if water else None,
+        }
+    return batch
+
+
+def run_single(args, files: ExitStack, output_file) -> list[str]:
+    """Generates the invoices of the --property and returns the written invoices"""
+    prop = find_property(args.property_code, args.street_address, args.city_state_zip)
+    to_workbook = args.output.lower().endswith(".xlsx")
+    zip_file = None if to_workbook else output_file
+    return utils.generate_invoice_from_user_inputs(
+        book=files.enter_context(open(args.book, "rb")),
+        waters=files.enter_context(open(args.water, "rb")) if args.water else None,
+        statement_date=args.statement_date,
+        prop=prop,
+        template_path=args.template_path,
+        export_path=None if zip_file else os.path.join(args.output, ""),
+        sheet_name=args.sheet,
+        company=BusinessEntityParams(),
+        workers=args.workers,
+        excel_engine=args.excel_engine,
+        zip_buffer=zip_file,
+        incremental=args.incremental,
+        lots=args.lots,
+        render_engine=args.render_engine,
+        workbook=output_file if to_workbook else None,
+        water_store=WaterReadingStore(args.water_store) if args.water_store else None,
+        ledger=InvoiceLedger(args.ledger) if args.ledger else None,
+        sheet_cache=(
+            SheetCache(args.sheet_cache, args.sheet_cache_max_bytes)
+            if args.sheet_cache
+            else None
+        ),
+        chunk_size=args.chunk_size,
+    )
+
+
+def run_batch(args, files: ExitStack, zip_file) -> list[str]:
+    """
+    Generates the invoices of every property of the --batch file into one archive,
+    prints the outcome of each property and returns the written invoices. Raises an
+    InvoiceRenderError if any property or invoice failed.
+    """
+    batch = load_batch(args.batch, args.book)
+    opened = {}
+    for inputs in batch.values():
+        for key in ("book", "waters"):
+            path = inputs[key]
+            if path is not None:
+                if path not in opened:
+                    opened[path] = files.enter_context(open(path, "rb"))
+                inputs[key] = opened[path]
+
+    properties = utils.get_properties() or []
+    unlisted = [
+        p["property_code"] for p in properties if p["property_code"] not in batch
+    ]
+    if unlisted:
+        print(f"Not in the batch: {', '.join(unlisted)}", file=sys.stderr)
+
+    results = utils.generate_property_batch_zip(
+        batch=batch,
+        properties=properties,
+        statement_date=args.statement_date,
+        template_path=args.template_path,
+        zip_buffer=zip_file,
+        company=BusinessEntityParams(),
+        workers=args.workers,
+        excel_engine=args.excel_engine,
+        render_engine=args.render_engine,
+        water_store=WaterReadingStore(args.water_store) if args.water_store else None,
+        ledger=InvoiceLedger(args.ledger) if args.ledger else None,
+        sheet_cache=(
+            SheetCache(args.sheet_cache, args.sheet_cache_max_bytes)
+            if args.sheet_cache
+            else None
+        ),
+    )
+
+    written = []
+    failures = {}
+    for property_code, result in results.items():
+        print(f"{property_code}: {len(result.invoices)} invoice(s)")
+        written.extend(result.invoices)
+        failures.update(result.failures)
+        if result.error:
+            failures[property_code] = result.error
+    if failures:
+        raise InvoiceRenderError(failures=failures, export_file_paths=written)
+    return written
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    to_zip = args.output.lower().endswith(".zip")
+    to_workbook = args.output.lower().endswith(".xlsx")
+    if args.incremental and (to_zip or to_workbook):
+        parser.error("--incremental needs an --output directory")
+    if args.batch:
+        if not to_zip:
+            parser.error("--batch writes a single .zip --output")
+    else:
+        if args.book is None or args.property_code is None:
+            parser.error("--book and --property are required without --batch")
+        prop = find_property(
+            args.property_code, args.street_address, args.city_state_zip
+        )
+        if "street_address" not in prop or "city_state_zip" not in prop:
+            parser.error(
+                f"property {args.property_code} is not listed in "
+                "template/properties.csv; pass --street-address and --city-state-zip"
+            )
+    if not to_zip and not to_workbook:
+        os.makedirs(args.output, exist_ok=True)
+
+    metrics = instrumentation.RunMetrics(
+        profiler=cProfile.Profile() if args.profile else None,
+        property_code=args.property_code,
+        sheet_name=args.sheet,
+        lots=args.lots,
+        batch=args.batch,
+        statement_date=args.statement_date,
+        workers=args.workers,
+        render_engine=args.render_engine,
+        entry_point="cli",
+    )
+
+    exit_code = 0
+    written = []
+    # a .zip or .xlsx output is written next to its destination and only moved in
+    # place once the run got that far, so a failed run leaves no truncated file
+    temp_output = f"{args.output}.{os.getpid()}.tmp" if to_zip or to_workbook else None
+    try:
+        with ExitStack() as files:
+            output_file = None
+            if temp_output is not None:
+                output_file = files.enter_context(open(temp_output, "wb"))
+            try:
+                with metrics:
+                    if args.batch:
+                        written = run_batch(args, files, output_file)
+                    else:
+                        written = run_single(args, files, output_file)
+            except InvoiceRenderError as e:
+                metrics.error = str(e)
+                written = e.export_file_paths
+                for invoice, reason in e.failures.items():
+                    print(f"{invoice}: {reason}", file=sys.stderr)
+                exit_code = 1
+            except Exception as e:
+                metrics.error = repr(e)
+                print(f"{parser.prog}: error: {error_message(e)}", file=sys.stderr)
+                return 2
+            finally:
+                if args.metrics_log:
+                    metrics.append_to_log(args.metrics_log)
+        if temp_output is not None:
+            os.replace(temp_output, args.output)
+            temp_output = None
+    finally:
+        if temp_output is not None and os.path.exists(temp_output):
+            os.remove(temp_output)
+
+    print(f"Generated {len(written)} invoice(s) in {args.output}")
+    if args.profile:
+        print(metrics.profile_summary(), file=sys.stderr)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
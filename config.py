@@ -9,6 +9,19 @@ class AppConfig(BaseSettings):
     port: int = 8001
     template_path: str = "template/bill_template.xlsx"
     output_path: str = "invoices/"
+    save_invoice_files: bool = False
+    reuse_unchanged_invoices: bool = True
+    workspace_ttl_seconds: int = 3600
+    render_workers: int = 1
+    generation_jobs: int = 1
+    render_engine: str = "openpyxl"
+    stream_chunk_lots: int | None = None
+    excel_engine: str | None = None
+    metrics_log_path: str = "logs/runs.jsonl"
+    water_store_path: str | None = None
+    invoice_ledger_path: str | None = None
+    sheet_cache_path: str | None = None
+    sheet_cache_max_bytes: int = 256 * 2**20
 
     model_config = SettingsConfigDict(
         env_file=".env", env_file_encoding="utf-8", extra="ignore"
@@ -1,15 +1,23 @@
 from datetime import date
 from datetime import datetime
+from typing import Annotated
 from typing import Optional
 from uuid import UUID
 from uuid import uuid4
 
+import pandas as pd
 from pydantic import BaseModel
+from pydantic import ConfigDict
 from pydantic import Field
+from pydantic import PrivateAttr
+from pydantic import TypeAdapter
 from pydantic import field_serializer
 from pydantic import model_validator
+from pydantic import with_config
 from pydantic_settings import SettingsConfigDict
 from pytz import timezone
+from typing_extensions import NotRequired
+from typing_extensions import TypedDict
 
 
 def et_datetime_now():
@@ -62,6 +70,56 @@ class WaterUsage(BaseModel):
         return round(self.water_usage * water_rate + service_fee, 2)
 
 
+class WaterReadingError(BaseModel):
+    lot_id: int | str
+    watermeter_id: Optional[float] = None
+    previous_reading: Optional[float] = None
+    current_reading: Optional[float] = None
+    reason: str
+
+
+class WaterUsageReport(BaseModel):
+    """
+    Validated water usage report. Readings are held column-wise in a DataFrame indexed
+    by lot number with watermeter_id, previous_reading and current_reading columns.
+    WaterUsage objects are only built for the lots that are looked up.
+    """
+
+    previous_date: date
+    current_date: date
+    statement_date: date
+    readings: pd.DataFrame
+    errors: list[WaterReadingError] = Field(default_factory=list)
+    _usages: dict[int, WaterUsage] = PrivateAttr(default_factory=dict)
+
+    model_config = SettingsConfigDict(arbitrary_types_allowed=True)
+
+    @property
+    def water_usage(self) -> pd.Series:
+        return self.readings["current_reading"] - self.readings["previous_reading"]
+
+    def __contains__(self, lot_id: int) -> bool:
+        return lot_id in self.readings.index
+
+    def __getitem__(self, lot_id: int) -> WaterUsage:
+        if lot_id not in self._usages:
+            row = self.readings.loc[[lot_id]].iloc[-1]
+            self._usages[lot_id] = WaterUsage(
+                watermeter_id=row["watermeter_id"],
+                previous_date=self.previous_date,
+                current_date=self.current_date,
+                statement_date=self.statement_date,
+                previous_reading=row["previous_reading"],
+                current_reading=row["current_reading"],
+            )
+        return self._usages[lot_id]
+
+    def errors_for(self, lot_ids: list[int]) -> list[WaterReadingError]:
+        """Errors of the report rows belonging to any of lot_ids"""
+        lots = set(lot_ids)
+        return [e for e in self.errors if e.lot_id in lots]
+
+
 class Property(BaseModel):
     property_code: str = Field(default="")
     street_address: str = Field(default="")
@@ -70,6 +128,15 @@ class Property(BaseModel):
     model_config = SettingsConfigDict(arbitrary_types_allowed=True)
 
 
+class PropertyBatchResult(BaseModel):
+    """Outcome of one property of a multi-property batch run"""
+
+    property_code: str
+    invoices: list[str] = Field(default_factory=list)
+    failures: dict[str, str] = Field(default_factory=dict)
+    error: Optional[str] = None
+
+
 class InvoiceFileParse(BaseModel):
     A1: str = Field(default="", alias="business_name")
     A2: str = Field(default="", alias="business_address_1")
@@ -127,6 +194,47 @@ class InvoiceFileParse(BaseModel):
     model_config = SettingsConfigDict(populate_by_name=True)
 
 
+def _invoice_cell_annotation(field):
+    annotation = Annotated[field.annotation, Field(alias=field.alias)]
+    return annotation if field.is_required() else NotRequired[annotation]
+
+
+# Cell values of an invoice keyed by cell, with the fields, types and aliases of
+# InvoiceFileParse. This is the form invoices are rendered from: a batch is validated
+# in one pass by validate_invoice_cells, without a model instance per invoice.
+InvoiceCells = with_config(ConfigDict(populate_by_name=True))(
+    TypedDict(
+        "InvoiceCells",
+        {
+            name: _invoice_cell_annotation(field)
+            for name, field in InvoiceFileParse.model_fields.items()
+        },
+    )
+)
+
+_invoice_cells_adapter = TypeAdapter(list[InvoiceCells])
+_invoice_cell_defaults = [
+    (name, field)
+    for name, field in InvoiceFileParse.model_fields.items()
+    if not field.is_required()
+]
+
+
+def validate_invoice_cells(input_data: list[dict]) -> list[InvoiceCells]:
+    """
+    Validates a batch of invoice inputs exactly as InvoiceFileParse(**i) would, and
+    returns each as the dict InvoiceFileParse.model_dump() would give. Raises a
+    ValidationError naming the position of the invalid input in the batch.
+    """
+    invoices = _invoice_cells_adapter.validate_python(input_data)
+    for invoice in invoices:
+        if len(invoice) < len(InvoiceFileParse.model_fields):
+            for name, field in _invoice_cell_defaults:
+                if name not in invoice:
+                    invoice[name] = field.get_default(call_default_factory=True)
+    return invoices
+
+
 class BookIngest(BaseModel):
     lot_id: int
     tenant_name: str
@@ -0,0 +1,116 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+
+_current_run: ContextVar["RunMetrics | None"] = ContextVar("current_run", default=None)
+
+
+class RunMetrics:
+    """
+    Wall time and counters of one invoice generation run, broken down by stage.
+
+    Used as a context manager around the run. While it is active, the module level
+    stage() and count() helpers called anywhere in the pipeline record into it, and
+    the optional profiler (e.g. a cProfile.Profile) is enabled.
+    """
+
+    def __init__(self, profiler: cProfile.Profile | None = None, **labels):
+        self.labels = labels
+        self.profiler = profiler
+        self.started_at: datetime | None = None
+        self.seconds: float | None = None
+        self.stages: dict[str, dict] = {}
+        self.counters: Counter = Counter()
+        self.error: str | None = None
+        self._start = None
+        self._token = None
+
+    def __enter__(self) -> "RunMetrics":
+        self.started_at = datetime.now()
+        self._start = time.perf_counter()
+        self._token = _current_run.set(self)
+        if self.profiler is not None:
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.profiler is not None:
+            self.profiler.disable()
+        _current_run.reset(self._token)
+        self.seconds = time.perf_counter() - self._start
+        if exc is not None:
+            self.error = repr(exc)
+        return False
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Times a stage; counters can be added to the yielded dict. A stage entered more
+        than once in a run, e.g. once per property of a batch, adds up its time and
+        numeric counters.
+        """
+        counters = {}
+        start = time.perf_counter()
+        try:
+            yield counters
+        finally:
+            stage = self.stages.setdefault(name, {"seconds": 0.0})
+            stage["seconds"] += time.perf_counter() - start
+            for key, value in counters.items():
+                if isinstance(value, (int, float)) and key in stage:
+                    stage[key] += value
+                else:
+                    stage[key] = value
+
+    def profile_summary(self, limit: int = 25) -> str | None:
+        """Top functions of the profiled run by cumulative time"""
+        if self.profiler is None:
+            return None
+        out = io.StringIO()
+        pstats.Stats(self.profiler, stream=out).sort_stats("cumulative").print_stats(
+            limit
+        )
+        return out.getvalue()
+
+    def to_dict(self) -> dict:
+        return {
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "seconds": self.seconds,
+            **self.labels,
+            "stages": self.stages,
+            "counters": dict(self.counters),
+            "error": self.error,
+        }
+
+    def append_to_log(self, log_path: str):
+        """Appends the run as one JSON line to log_path"""
+        log_dir = os.path.dirname(log_path)
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+        with open(log_path, "a") as log_file:
+            log_file.write(json.dumps(self.to_dict(), default=str) + "\n")
+
+
+@contextmanager
+def stage(name: str):
+    """Times a stage of the active run. Does nothing but yield a dict if there is none"""
+    run = _current_run.get()
+    if run is None:
+        yield {}
+        return
+    with run.stage(name) as counters:
+        yield counters
+
+
+def count(name: str, n: int = 1):
+    """Adds n to a counter of the active run, if there is one"""
+    run = _current_run.get()
+    if run is not None:
+        run.counters[name] += n
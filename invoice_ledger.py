@@ -0,0 +1,254 @@
+import json
+import os
+import sqlite3
+from contextlib import closing
+from datetime import date
+from datetime import datetime
+
+import pandas as pd
+
+import data_models as models
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS invoices (
+    property_code TEXT NOT NULL,
+    lot_id NOT NULL,
+    statement_date TEXT NOT NULL,
+    invoice_id TEXT NOT NULL,
+    tenant_name TEXT,
+    amt_rent REAL,
+    amt_storage REAL,
+    amt_water REAL,
+    amt_other_rent REAL,
+    amt_overdue REAL,
+    amt_late_fee REAL,
+    amount_due REAL,
+    cells TEXT NOT NULL,
+    recorded_at TEXT NOT NULL,
+    UNIQUE (property_code, lot_id, statement_date)
+);
+CREATE INDEX IF NOT EXISTS invoices_by_date
+    ON invoices (statement_date, property_code);
+"""
+
+# Ledger column of each invoice cell kept outside of the cells payload
+LEDGER_CELLS = {
+    "tenant_name": "B7",
+    "amt_rent": "F16",
+    "amt_storage": "F18",
+    "amt_water": "F17",
+    "amt_other_rent": "F19",
+    "amt_overdue": "F20",
+    "amt_late_fee": "F15",
+    "amount_due": "F5",
+}
+
+AMOUNT_DTYPES = {
+    column: "float64" for column in LEDGER_CELLS if column != "tenant_name"
+}
+
+# Labels of the ledger columns in the display view
+DISPLAY_COLUMNS = {
+    "property_code": "property",
+    "statement_date": "statement date",
+    "lot_id": "lot",
+    "tenant_name": "account holder name",
+    "amt_rent": "rent",
+    "amt_storage": "storage",
+    "amt_water": "water",
+    "amt_other_rent": "other rent",
+    "amt_overdue": "overdue",
+    "amt_late_fee": "late fees",
+    "amount_due": "total invoice due",
+}
+
+
+class InvoiceLedger:
+    """
+    Invoice data of every generation run, kept in a SQLite file with one row per
+    property, lot and statement date, so that past invoices can be listed and
+    summarized without generating them again or re-reading the invoice files.
+
+    The amounts shown by the display views are columns of their own; the complete
+    cell values of each invoice are kept as JSON. Regenerating the invoices of a
+    statement date replaces their rows. Each call commits on a connection of its own,
+    so the rows a generation job records, chunk by chunk when streaming, show up at
+    once in the ledger expander of every session while the job is still running.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def record(
+        self,
+        property_code: str,
+        statement_date: date,
+        input_data: list[models.InvoiceCells],
+        recorded_at: datetime | None = None,
+    ) -> int:
+        """
+        Records the invoices of a property for a statement date, replacing those of
+        the same lots recorded before.
+
+        Args:
+            property_code (str): property the invoices belong to
+            statement_date (date): statement date of the invoices
+            input_data (list[models.InvoiceCells]): validated invoice data
+            recorded_at (datetime | None, optional):
+                Time of the run. Defaults to now.
+
+        Returns:
+            int: number of invoices recorded
+        """
+        recorded_at = (recorded_at or datetime.now()).isoformat(timespec="seconds")
+        rows = [
+            (
+                property_code,
+                _lot_id(invoice["F4"], property_code),
+                statement_date.isoformat(),
+                invoice["F4"],
+                *(invoice[cell] for cell in LEDGER_CELLS.values()),
+                json.dumps(invoice, default=date.isoformat),
+                recorded_at,
+            )
+            for invoice in input_data
+        ]
+        if not rows:
+            return 0
+        placeholders = ", ".join("?" * len(rows[0]))
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                f"INSERT OR REPLACE INTO invoices VALUES ({placeholders})", rows
+            )
+        return len(rows)
+
+    def summary(
+        self,
+        property_codes: list[str] | None = None,
+        start: date | None = None,
+        end: date | None = None,
+        lots: list[int] | None = None,
+    ) -> pd.DataFrame:
+        """
+        Amounts of the recorded invoices, one row per invoice ordered by statement
+        date, property and lot.
+
+        Args:
+            property_codes (list[str] | None, optional):
+                Properties to include. Defaults to all.
+            start (date | None, optional): first statement date to include
+            end (date | None, optional): last statement date to include
+            lots (list[int] | None, optional): lot numbers to include
+
+        Returns:
+            pd.DataFrame: property_code, statement_date, lot_id and the columns of
+            LEDGER_CELLS
+        """
+        where, params = _filters(property_codes, start, end, lots)
+        columns = ", ".join(
+            ["property_code", "statement_date", "lot_id", *LEDGER_CELLS]
+        )
+        with closing(self._connect()) as conn:
+            df = pd.read_sql_query(
+                f"SELECT {columns} FROM invoices {where}"
+                " ORDER BY statement_date, property_code, lot_id",
+                conn,
+                params=params,
+                dtype=AMOUNT_DTYPES,
+            )
+        df["statement_date"] = [date.fromisoformat(d) for d in df["statement_date"]]
+        return df
+
+    def totals(
+        self,
+        property_codes: list[str] | None = None,
+        start: date | None = None,
+        end: date | None = None,
+    ) -> pd.DataFrame:
+        """
+        Number of invoices and sum of each amount per statement date and property.
+
+        Args:
+            property_codes (list[str] | None, optional):
+                Properties to include. Defaults to all.
+            start (date | None, optional): first statement date to include
+            end (date | None, optional): last statement date to include
+
+        Returns:
+            pd.DataFrame: statement_date, property_code, invoices and the summed
+            amount columns of LEDGER_CELLS
+        """
+        where, params = _filters(property_codes, start, end)
+        sums = ", ".join(f"SUM({column}) AS {column}" for column in AMOUNT_DTYPES)
+        with closing(self._connect()) as conn:
+            df = pd.read_sql_query(
+                f"SELECT statement_date, property_code, COUNT(*) AS invoices, {sums}"
+                f" FROM invoices {where}"
+                " GROUP BY statement_date, property_code"
+                " ORDER BY statement_date, property_code",
+                conn,
+                params=params,
+                dtype=AMOUNT_DTYPES,
+            )
+        df["statement_date"] = [date.fromisoformat(d) for d in df["statement_date"]]
+        return df
+
+    def invoices(
+        self, property_code: str, statement_date: date
+    ) -> list[models.InvoiceCells]:
+        """
+        Complete invoice data recorded for a property and statement date, ordered by
+        lot, in the form the invoices are rendered from.
+
+        Args:
+            property_code (str): property of the invoices
+            statement_date (date): statement date of the invoices
+
+        Returns:
+            list[models.InvoiceCells]: validated invoice data, one per recorded lot
+        """
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT cells FROM invoices"
+                " WHERE property_code = ? AND statement_date = ? ORDER BY lot_id",
+                (property_code, statement_date.isoformat()),
+            ).fetchall()
+        return models.validate_invoice_cells([json.loads(cells) for (cells,) in rows])
+
+
+def _lot_id(invoice_id: str, property_code: str) -> int | str:
+    """Lot of an invoice, whose id is the property code followed by the lot number"""
+    lot = invoice_id.removeprefix(property_code)
+    return int(lot) if lot.isdigit() else lot
+
+
+def _filters(
+    property_codes: list[str] | None,
+    start: date | None,
+    end: date | None,
+    lots: list[int] | None = None,
+) -> tuple[str, list]:
+    conditions = []
+    params = []
+    if property_codes is not None:
+        conditions.append(f"property_code IN ({', '.join('?' * len(property_codes))})")
+        params.extend(property_codes)
+    if start is not None:
+        conditions.append("statement_date >= ?")
+        params.append(start.isoformat())
+    if end is not None:
+        conditions.append("statement_date <= ?")
+        params.append(end.isoformat())
+    if lots is not None:
+        conditions.append(f"lot_id IN ({', '.join('?' * len(lots))})")
+        params.extend(lots)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return where, params
@@ -0,0 +1,126 @@
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from threading import Lock
+from typing import Callable
+
+import instrumentation
+
+
+class InvoiceJob:
+    """
+    A generation run submitted to a JobQueue. The run is executed inside its metrics,
+    so the stage timings and the invoices_total / invoices_done counters recorded
+    by the pipeline can be read while it is running.
+    """
+
+    def __init__(self, session_id: str, metrics: instrumentation.RunMetrics):
+        self.session_id = session_id
+        self.metrics = metrics
+        self.submitted_at = datetime.now()
+        self.finished_at: datetime | None = None
+        self.started = False
+        self.future: Future | None = None
+
+    @property
+    def done(self) -> bool:
+        return self.future is not None and self.future.done()
+
+    @property
+    def progress(self) -> tuple[int, int]:
+        """Invoices rendered so far and invoices to render, 0 and 0 until rendering"""
+        counters = self.metrics.counters
+        return counters["invoices_done"], counters["invoices_total"]
+
+    def result(self):
+        """Returns what the run returned, or raises what it raised"""
+        return self.future.result()
+
+
+class JobQueue:
+    """
+    Runs generation jobs on a bounded pool of background threads, first come first
+    served. A session can have one unfinished job at a time, so sessions are served
+    in the order they submitted and a busy session cannot hold back the others.
+    Finished jobs whose session did not collect them within ttl_seconds, e.g. after
+    the browser tab was closed, are dropped at the next submission.
+    """
+
+    def __init__(self, max_workers: int = 1, ttl_seconds: float = 3600):
+        self.max_workers = max_workers
+        self.ttl_seconds = ttl_seconds
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="invoice-job"
+        )
+        self._lock = Lock()
+        self._jobs: dict[str, InvoiceJob] = {}
+
+    def submit(
+        self,
+        session_id: str,
+        metrics: instrumentation.RunMetrics,
+        fn: Callable,
+        *args,
+        **kwargs,
+    ) -> InvoiceJob:
+        """
+        Queues fn(*args, **kwargs) as the job of session_id.
+
+        Args:
+            session_id (str): identifier of the session submitting the job
+            metrics (instrumentation.RunMetrics): metrics to run the job inside
+            fn (Callable): generation function to run
+
+        Raises:
+            RuntimeError: if the session already has an unfinished job
+
+        Returns:
+            InvoiceJob: the queued job
+        """
+        job = InvoiceJob(session_id, metrics)
+        with self._lock:
+            for expired in [
+                other.session_id
+                for other in self._jobs.values()
+                if other.done
+                and (job.submitted_at - other.finished_at).total_seconds()
+                > self.ttl_seconds
+            ]:
+                del self._jobs[expired]
+            current = self._jobs.get(session_id)
+            if current is not None and not current.done:
+                raise RuntimeError("An invoice generation is already in progress")
+            self._jobs[session_id] = job
+            job.future = self._executor.submit(self._run, job, fn, *args, **kwargs)
+        return job
+
+    @staticmethod
+    def _run(job: InvoiceJob, fn: Callable, *args, **kwargs):
+        job.started = True
+        try:
+            with job.metrics:
+                return fn(*args, **kwargs)
+        finally:
+            job.finished_at = datetime.now()
+
+    def job(self, session_id: str) -> InvoiceJob | None:
+        """The last job submitted by session_id, if any"""
+        return self._jobs.get(session_id)
+
+    def position(self, job: InvoiceJob) -> int:
+        """Number of unfinished jobs submitted before job, 0 once it has started"""
+        if job.started:
+            return 0
+        with self._lock:
+            return sum(
+                1
+                for other in self._jobs.values()
+                if not other.done and other.submitted_at < job.submitted_at
+            )
+
+    def forget(self, session_id: str):
+        """Drops the finished job of session_id, once its results were shown"""
+        with self._lock:
+            job = self._jobs.get(session_id)
+            if job is not None and job.done:
+                del self._jobs[session_id]
@@ -1,8 +1,21 @@
+import cProfile
+from functools import partial
+from io import BytesIO
+from uuid import uuid4
+
 import streamlit as st
 
+import instrumentation
 import utils
+import widgets
 from config import AppConfig
 from config import BusinessEntityParams
+from invoice_ledger import InvoiceLedger
+from jobs import InvoiceJob
+from jobs import JobQueue
+from rendering import InvoiceRenderError
+from sheet_cache import SheetCache
+from water_store import WaterReadingStore
 
 
 def initialize_state():
@@ -24,9 +37,68 @@ try:
 except FileNotFoundError:
     st.error("Property file not found")
 
-utils.statement_date_widget()
+widgets.statement_date_widget()
+
+widgets.properties_widget(st.session_state.props)
+
+
+@st.cache_resource
+def job_queue() -> JobQueue:
+    """Background generation jobs, shared by every session of the app"""
+    return JobQueue(
+        max_workers=app_config.generation_jobs,
+        ttl_seconds=app_config.workspace_ttl_seconds,
+    )
+
 
-utils.properties_widget(st.session_state.props)
+def job_upload(uploaded_file: BytesIO | None) -> BytesIO | None:
+    """
+    Copy of an uploaded file for a background job, as the reruns of the page read
+    the upload itself while the job runs
+    """
+    return BytesIO(uploaded_file.getvalue()) if uploaded_file else None
+
+
+def show_job_results(
+    job: InvoiceJob,
+    batch_mode: bool,
+    zip_buffer: BytesIO,
+    workbook: BytesIO | None,
+):
+    """Shows the outcome of a finished generation job and offers its download"""
+    metrics = job.metrics
+    try:
+        if batch_mode:
+            results = job.result()
+            metrics.error = (
+                "; ".join(
+                    f"{code}: {result.error}"
+                    for code, result in results.items()
+                    if result.error
+                )
+                or None
+            )
+            widgets.property_batch_results_widget(results)
+            widgets.user_download_invoice_zip(zip_buffer=zip_buffer)
+        else:
+            file_paths = job.result()
+            st.write(f"Generated {len(file_paths)} invoice(s)")
+            widgets.user_download_invoices(zip_buffer, workbook)
+    except InvoiceRenderError as e:
+        metrics.error = str(e)
+        st.write(f"Generated {len(e.export_file_paths)} invoice(s)")
+        st.warning(
+            "The following invoice(s) could not be generated:\n"
+            + "\n".join(f"- {k}: {v}" for k, v in e.failures.items())
+        )
+        widgets.user_download_invoices(zip_buffer, workbook)
+    except AssertionError as e:
+        metrics.error = repr(e)
+        st.error("Please make sure the worksheet name is correct")
+    except Exception as e:
+        metrics.error = repr(e)
+        st.error(e)
+        st.write("Wunnuheyo")
 
 
 def main():
@@ -46,11 +118,41 @@ def main():
         st.session_state.prop = None
     if "override_water" not in st.session_state:
         st.session_state.override_water = False
+    if "profile_run" not in st.session_state:
+        st.session_state.profile_run = False
+    if "last_run_metrics" not in st.session_state:
+        st.session_state.last_run_metrics = None
+    if "last_run_profile" not in st.session_state:
+        st.session_state.last_run_profile = None
+    if "workspace_id" not in st.session_state:
+        st.session_state.workspace_id = uuid4().hex
+    if "batch_mode" not in st.session_state:
+        st.session_state.batch_mode = False
+    if "lots" not in st.session_state:
+        st.session_state.lots = None
+    if "single_workbook" not in st.session_state:
+        st.session_state.single_workbook = False
 
     template_path = app_config.template_path
-    export_path = app_config.output_path
     company = BusinessEntityParams()
     statement_date = st.session_state.statement_date
+    ledger = (
+        InvoiceLedger(app_config.invoice_ledger_path)
+        if app_config.invoice_ledger_path
+        else None
+    )
+    sheet_cache = (
+        SheetCache(app_config.sheet_cache_path, app_config.sheet_cache_max_bytes)
+        if app_config.sheet_cache_path
+        else None
+    )
+
+    st.session_state.batch_mode = st.sidebar.checkbox(
+        label="Invoice all properties",
+    )
+    st.session_state.single_workbook = not st.session_state.batch_mode and (
+        st.sidebar.checkbox(label="One workbook with a sheet per invoice")
+    )
 
     st.header("Generate invoice from book")
 
@@ -59,73 +161,181 @@ def main():
     st.session_state.uploaded_book = st.file_uploader(
         "Upload the bookkeeping file (.xlsx)", type=["xlsx"]
     )
-    st.session_state.sheet_name = st.text_input(
-        "Enter the name of the bookkeeping worksheet to use for invoicing (Invoices will not be generated if sheet name is unspecified):",  # noqa: E501\
-        value=None,
-    )
-
+    sheet_names = []
     if st.session_state.uploaded_book:
         st.success("Bookkeeping file is uploaded")
-        if st.session_state.sheet_name and len(st.session_state.sheet_name) >= 0:
-            try:
-                utils.ingest_bookkeeping_excel(
-                    st.session_state.uploaded_book, sheet_name=st.session_state.sheet_name
-                )
-                st.session_state.sheet_name_correct = True
-            except Exception as e:
-                print(e)
-                st.error(
-                    f"Sheet name {st.session_state.sheet_name} does not exist. \
-                    If sheet name is left blank, the last worksheet will be invoiced."
-                )
+        try:
+            sheet_names = utils.list_excel_sheet_names(st.session_state.uploaded_book)
+        except Exception as e:
+            print(e)
+            st.error("Could not read the worksheets of the bookkeeping file")
+    if st.session_state.uploaded_book and not st.session_state.batch_mode:
+        st.session_state.sheet_name = st.selectbox(
+            "Select the bookkeeping worksheet to use for invoicing (defaults to the last worksheet):",  # noqa: E501
+            options=sheet_names,
+            index=len(sheet_names) - 1 if sheet_names else None,
+        )
+        st.session_state.sheet_name_correct = st.session_state.sheet_name is not None
+        if st.session_state.sheet_name is not None:
+            st.session_state.lots = widgets.lots_widget(
+                st.session_state.uploaded_book,
+                st.session_state.sheet_name,
+                excel_engine=app_config.excel_engine,
+            )
     else:
+        st.session_state.sheet_name = None
+        st.session_state.sheet_name_correct = False
+        st.session_state.lots = None
+    if not st.session_state.uploaded_book:
         st.info("Bookkeeping file needs to be uploaded")
 
-    st.markdown("### Upload water report")
-    st.info("Note, current reading month is usually one month before the statement date")
-    st.session_state.uploaded_water = st.file_uploader(
-        "Upload the water report Excel file (.xlsx)", type=["xlsx"]
-    )
+    batch = {}
+    if st.session_state.batch_mode:
+        st.markdown("### Select the worksheet and water report of each property")
+        st.info(
+            "Note, current reading month is usually one month before the statement date"
+        )
+        batch = widgets.property_batch_widget(st.session_state.props or [], sheet_names)
+        st.session_state.uploaded_water = None
+    else:
+        st.markdown("### Upload water report")
+        st.info(
+            "Note, current reading month is usually one month before the statement date"
+        )
+        st.session_state.uploaded_water = st.file_uploader(
+            "Upload the water report Excel file (.xlsx)", type=["xlsx"]
+        )
 
-    if st.session_state.uploaded_water:
-        st.success("Water usage report uploaded")
+        if st.session_state.uploaded_water:
+            st.success("Water usage report uploaded")
 
     st.session_state.override_water = st.sidebar.checkbox(
         label="Check to skip water report upload",
     )
 
-    water_check = st.session_state.uploaded_water or st.session_state.override_water
+    st.session_state.profile_run = st.sidebar.checkbox(
+        label="Profile the next run",
+    )
+
+    if st.session_state.batch_mode:
+        water_check = st.session_state.override_water or all(
+            inputs["waters"] for inputs in batch.values()
+        )
+        inputs_check = bool(batch) and all(
+            inputs["sheet_name"] is not None for inputs in batch.values()
+        )
+    else:
+        water_check = st.session_state.uploaded_water or st.session_state.override_water
+        inputs_check = st.session_state.sheet_name is not None and st.session_state.prop
 
-    st.session_state.generate_invoices = st.button("Generate invoices")
+    queue = job_queue()
+    job = queue.job(st.session_state.workspace_id)
+    st.session_state.generate_invoices = st.button(
+        "Generate invoices", disabled=job is not None and not job.done
+    )
 
     if (
         water_check
-        and st.session_state.uploaded_book is not None
-        and st.session_state.sheet_name is not None
-        and st.session_state.prop
+        and st.session_state.uploaded_book
+        and inputs_check
         and st.session_state.generate_invoices
     ):
-        utils.clear_directory(export_path)
+        export_path = None
+        if app_config.save_invoice_files:
+            utils.remove_expired_workspaces(
+                app_config.output_path, app_config.workspace_ttl_seconds
+            )
+            export_path = utils.session_workspace(
+                app_config.output_path, st.session_state.workspace_id
+            )
+            if not app_config.reuse_unchanged_invoices:
+                utils.clear_directory(export_path)
+        zip_buffer = BytesIO()
+        workbook = BytesIO() if st.session_state.single_workbook else None
+        water_store = (
+            WaterReadingStore(app_config.water_store_path)
+            if app_config.water_store_path
+            else None
+        )
 
-        try:
-            file_paths = utils.generate_invoice_from_user_inputs(
-                book=st.session_state.uploaded_book,
-                waters=st.session_state.uploaded_water,
-                statement_date=statement_date,
+        if st.session_state.batch_mode:
+            run_labels = {"property_code": list(batch)}
+        else:
+            run_labels = {
+                "property_code": st.session_state.prop["property_code"],
+                "sheet_name": st.session_state.sheet_name,
+                "lots": st.session_state.lots,
+            }
+        metrics = instrumentation.RunMetrics(
+            profiler=cProfile.Profile() if st.session_state.profile_run else None,
+            statement_date=statement_date,
+            workers=app_config.render_workers,
+            render_engine=app_config.render_engine,
+            **run_labels,
+        )
+        book = job_upload(st.session_state.uploaded_book)
+        if st.session_state.batch_mode:
+            generate = partial(
+                utils.generate_property_batch_zip,
+                batch={
+                    code: {
+                        **inputs,
+                        "book": book,
+                        "waters": job_upload(inputs["waters"]),
+                    }
+                    for code, inputs in batch.items()
+                },
+                properties=st.session_state.props,
+            )
+        else:
+            generate = partial(
+                utils.generate_invoice_from_user_inputs,
+                book=book,
+                waters=job_upload(st.session_state.uploaded_water),
                 prop=st.session_state.prop,
-                template_path=template_path,
-                export_path=export_path,
                 sheet_name=st.session_state.sheet_name,
-                company=company,
+                lots=st.session_state.lots,
+                workbook=workbook,
+                chunk_size=app_config.stream_chunk_lots,
             )
-            st.write(f"Generated {len(file_paths)} invoice(s)")
-            utils.user_download_invoice_zip(export_path)
-        except AssertionError:
-            st.error("Please make sure the worksheet name is correct")
-            st.stop()
-        except Exception as e:
-            st.error(e)
-            st.write("Wunnuheyo")
+        job = queue.submit(
+            st.session_state.workspace_id,
+            metrics,
+            generate,
+            statement_date=statement_date,
+            template_path=template_path,
+            zip_buffer=zip_buffer,
+            export_path=export_path,
+            company=company,
+            workers=app_config.render_workers,
+            excel_engine=app_config.excel_engine,
+            incremental=app_config.reuse_unchanged_invoices,
+            render_engine=app_config.render_engine,
+            water_store=water_store,
+            ledger=ledger,
+            sheet_cache=sheet_cache,
+        )
+        st.session_state.job_outputs = {
+            "batch_mode": st.session_state.batch_mode,
+            "zip_buffer": zip_buffer,
+            "workbook": workbook,
+        }
+
+    if job is not None and not job.done:
+        widgets.generation_job_widget(job, queue)
+    elif job is not None:
+        queue.forget(st.session_state.workspace_id)
+        show_job_results(job, **st.session_state.job_outputs)
+        metrics = job.metrics
+        metrics.append_to_log(app_config.metrics_log_path)
+        st.session_state.last_run_metrics = metrics.to_dict()
+        st.session_state.last_run_profile = metrics.profile_summary()
+
+    widgets.run_metrics_widget(
+        st.session_state.last_run_metrics, st.session_state.last_run_profile
+    )
+    if ledger is not None:
+        widgets.invoice_ledger_widget(ledger, st.session_state.props)
 
 
 if __name__ == "__main__":
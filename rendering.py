@@ -0,0 +1,1088 @@
+import copy
+import hashlib
+import json
+import os
+import pickle
+import re
+import zipfile
+from collections import deque
+from collections.abc import Callable
+from collections.abc import Iterable
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from datetime import time
+from io import BytesIO
+from threading import Lock
+from typing import BinaryIO
+from typing import get_args
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+from openpyxl import load_workbook
+from openpyxl.cell.cell import ERROR_CODES
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.compat import NUMERIC_TYPES
+from openpyxl.compat import safe_string
+from openpyxl.styles.numbers import is_date_format
+from openpyxl.utils.cell import column_index_from_string
+from openpyxl.utils.cell import coordinate_from_string
+from openpyxl.utils.datetime import to_excel
+from openpyxl.utils.exceptions import IllegalCharacterError
+from openpyxl.workbook.workbook import Workbook
+from openpyxl.worksheet.worksheet import Worksheet
+
+import data_models as models
+import instrumentation
+
+# Account activity lines of the invoice; the ones without a description are removed
+# and blank rows are added back before ACTIVITY_SECTION_END so that the remittance
+# slip below keeps its position.
+ACTIVITY_ROWS = range(13, 21)
+ACTIVITY_SECTION_END = 31
+
+
+class InvoiceTemplate:
+    """
+    Invoice template parsed once and kept as a pickled snapshot of the openpyxl
+    workbook. Each invoice is stamped onto a fresh copy restored from the snapshot,
+    which is several times cheaper than re-reading the .xlsx file with its styles.
+    """
+
+    engine = "openpyxl"
+
+    def __init__(self, template_path: str):
+        self.template_path = template_path
+        self.mtime = os.path.getmtime(template_path)
+        with open(template_path, "rb") as f:
+            self._content = f.read()
+        self.content_hash = hashlib.sha256(self._content).hexdigest()
+        wb = self.load_workbook()
+        self._snapshot = pickle.dumps(wb, protocol=pickle.HIGHEST_PROTOCOL)
+        wb.close()
+        self._layouts: dict[tuple[int, ...], InvoiceLayout] = {}
+
+    def is_stale(self) -> bool:
+        """True if the template file changed on disk since it was parsed"""
+        return os.path.getmtime(self.template_path) != self.mtime
+
+    def load_workbook(self) -> Workbook:
+        """Parses the template file content read at start-up"""
+        return load_workbook(BytesIO(self._content))
+
+    def new_workbook(self) -> Workbook:
+        """Returns an independent in-memory copy of the template workbook"""
+        return pickle.loads(self._snapshot)
+
+    def layout(self, empty_rows: tuple[int, ...]) -> "InvoiceLayout":
+        """
+        Returns the template compacted for the given empty account activity rows. Each
+        of the 2^8 layouts is built the first time an invoice needs it.
+        """
+        layout = self._layouts.get(empty_rows)
+        if layout is None:
+            layout = InvoiceLayout(self.load_workbook(), empty_rows)
+            self._layouts[empty_rows] = layout
+        return layout
+
+    def compile(self, input_data: list[models.InvoiceCells]) -> "CompiledTemplate":
+        """Compiles the template for a batch of invoices, see CompiledTemplate"""
+        with instrumentation.stage("compile_template") as counters:
+            constants = constant_fields(input_data)
+            counters["constant_fields"] = len(constants)
+            return CompiledTemplate(self, constants)
+
+
+class InvoiceLayout:
+    """
+    Template with a set of empty account activity rows already removed, as
+    remove_empty_rows would leave it, together with the (row, column) each
+    InvoiceFileParse field lands on after the removal. Fields on removed rows map to
+    None. The constants are fields whose values wb already holds in their template
+    cells, which move along with the rows; stamped_fields lists the remaining fields
+    to write per invoice, with their cell.
+    """
+
+    def __init__(
+        self, wb: Workbook, empty_rows: tuple[int, ...], constants: dict | None = None
+    ):
+        self.empty_rows = empty_rows
+        self.constants = constants or {}
+
+        self.coordinates = layout_coordinates(empty_rows)
+        self.stamped_fields: list[tuple[str, int, int]] = [
+            (field, *cell)
+            for field, cell in self.coordinates.items()
+            if cell is not None and field not in self.constants
+        ]
+
+        remove_activity_rows(wb.active, empty_rows)
+        self._snapshot = pickle.dumps(wb, protocol=pickle.HIGHEST_PROTOCOL)
+        wb.close()
+
+    def new_workbook(self) -> Workbook:
+        """Returns an independent in-memory copy of the compacted template"""
+        return pickle.loads(self._snapshot)
+
+
+def layout_coordinates(
+    empty_rows: tuple[int, ...],
+) -> dict[str, tuple[int, int] | None]:
+    """
+    (row, column) each InvoiceFileParse field lands on once the empty account activity
+    rows are removed, or None if its row is removed
+    """
+    coordinates = {}
+    for field in models.InvoiceFileParse.model_fields:
+        column, row = coordinate_from_string(field)
+        if row in empty_rows:
+            coordinates[field] = None
+        else:
+            if row < ACTIVITY_SECTION_END:
+                row -= sum(1 for r in empty_rows if r < row)
+            coordinates[field] = (row, column_index_from_string(column))
+    return coordinates
+
+
+def empty_activity_rows(invoice: models.InvoiceCells) -> tuple[int, ...]:
+    """Account activity rows without a description, which the invoice leaves out"""
+    return tuple(row for row in ACTIVITY_ROWS if invoice[f"C{row}"] is None)
+
+
+def constant_fields(input_data: list[models.InvoiceCells]) -> dict:
+    """
+    Fields with the same value, of the same type, in every invoice of input_data, e.g.
+    the business name and address or the statement date
+    """
+    if not input_data:
+        return {}
+    first, *others = input_data
+    return {
+        field: value
+        for field, value in first.items()
+        if all(
+            type(invoice[field]) is type(value) and invoice[field] == value
+            for invoice in others
+        )
+    }
+
+
+class CompiledTemplate:
+    """
+    Invoice template compiled for one batch of invoices. The fields that are constant
+    across the batch are written once into a base copy of the template, saved as
+    .xlsx content, and the layout of each set of empty account activity rows is
+    compacted from that base, so that only the fields that differ are stamped per
+    invoice.
+    """
+
+    def __init__(self, template: InvoiceTemplate, constants: dict):
+        self.template = template
+        self.constants = constants
+        wb = template.load_workbook()
+        ws = wb.active
+        for field, value in constants.items():
+            ws[field].value = value
+        # saved rather than pickled: a workbook restored from a pickle cannot be
+        # pickled again, which InvoiceLayout does with its compacted copy
+        base = BytesIO()
+        wb.save(base)
+        wb.close()
+        self._base = base.getvalue()
+        self._layouts: dict[tuple[int, ...], InvoiceLayout] = {}
+
+    def layout(self, empty_rows: tuple[int, ...]) -> InvoiceLayout:
+        """Returns the template layout for empty_rows, see CompiledTemplate"""
+        layout = self._layouts.get(empty_rows)
+        if layout is None:
+            layout = InvoiceLayout(
+                load_workbook(BytesIO(self._base)), empty_rows, self.constants
+            )
+            self._layouts[empty_rows] = layout
+        return layout
+
+    def render_bytes(self, invoice: models.InvoiceCells) -> bytes:
+        """Renders a single invoice and returns the content of its .xlsx file"""
+        return render_invoice_bytes(self, invoice)
+
+
+_SHEET_DATA_RE = re.compile(r"<sheetData\s*/>|<sheetData>(.*?)</sheetData>", re.S)
+_ROW_RE = re.compile(r"<row\b([^>]*?)(?:/>|>(.*?)</row>)", re.S)
+_CELL_RE = re.compile(r"<c\b([^>]*?)(?:/>|>(.*?)</c>)", re.S)
+_REF_ATTR_RE = re.compile(r'\s+r="([A-Z]*)(\d+)"')
+_TYPE_ATTR_RE = re.compile(r'\s+t="[^"]*"')
+_STYLE_ATTR_RE = re.compile(r'\s+s="[^"]*"')
+_FORMULA_RE = re.compile(r"<f\b[^>]*?(?:/>|>.*?</f>)", re.S)
+
+
+class XmlInvoiceTemplate:
+    """
+    Invoice template of the "xml" render engine, which treats the .xlsx file as a
+    package of XML parts rather than an openpyxl workbook. Each invoice patches its
+    cell values into the XML of the invoice sheet, moving the account activity rows
+    as remove_activity_rows does, and copies every other part byte for byte. The cells
+    are written the way openpyxl writes them, so the files open the same as those of
+    the "openpyxl" engine, which has to load and serialize the whole workbook.
+    """
+
+    engine = "xml"
+
+    def __init__(self, template_path: str):
+        self.template_path = template_path
+        self.mtime = os.path.getmtime(template_path)
+        with open(template_path, "rb") as f:
+            content = f.read()
+        self.content_hash = hashlib.sha256(content).hexdigest()
+
+        wb = load_workbook(BytesIO(content))
+        ws = wb.active
+        for field, info in models.InvoiceFileParse.model_fields.items():
+            if date in (info.annotation, *get_args(info.annotation)) and not (
+                is_date_format(ws[field].number_format)
+            ):
+                raise ValueError(
+                    f"Cell {field} of {template_path} needs a date number format to be "
+                    "rendered by the xml engine"
+                )
+        sheet_index = wb.index(ws)
+        wb.close()
+
+        with zipfile.ZipFile(BytesIO(content)) as package:
+            self._parts = [(info, package.read(info)) for info in package.infolist()]
+            self.sheet_part = _sheet_part(package, sheet_index)
+            sheet = package.read(self.sheet_part).decode()
+        if 't="shared"' in sheet:
+            raise ValueError(
+                f"{template_path} has shared formulas, which the xml engine cannot move"
+            )
+
+        sheet_data = _SHEET_DATA_RE.search(sheet)
+        self._sheet_head = sheet[: sheet_data.start()] + "<sheetData>"
+        self._sheet_tail = "</sheetData>" + sheet[sheet_data.end() :]
+        # attributes of each row and its cells as (column, letter, attributes, body)
+        self._rows: dict[int, str] = {}
+        self._cells: dict[int, list[tuple[int, str, str, str | None]]] = {}
+        for row_attrs, row_body in _ROW_RE.findall(sheet_data.group(1) or ""):
+            row = int(re.search(r'\br="(\d+)"', row_attrs).group(1))
+            self._rows[row] = re.sub(r'\s+r="[^"]*"', "", row_attrs)
+            cells = self._cells.setdefault(row, [])
+            for cell_attrs, cell_body in _CELL_RE.findall(row_body or ""):
+                letter = _REF_ATTR_RE.search(cell_attrs).group(1)
+                cell_attrs = _REF_ATTR_RE.sub("", cell_attrs)
+                formula = _FORMULA_RE.search(cell_body)
+                if formula:
+                    # openpyxl drops cached formula results, which the invoice data
+                    # makes stale, and Excel recalculates them on open
+                    cell_attrs = _TYPE_ATTR_RE.sub("", cell_attrs)
+                    cell_body = formula.group(0) + "<v></v>"
+                cells.append(
+                    (
+                        column_index_from_string(letter),
+                        letter,
+                        cell_attrs,
+                        cell_body or None,
+                    )
+                )
+        for field in models.InvoiceFileParse.model_fields:
+            letter, row = coordinate_from_string(field)
+            column = column_index_from_string(letter)
+            cells = self._cells.setdefault(row, [])
+            if all(cell[0] != column for cell in cells):
+                cells.append((column, letter, "", None))
+                cells.sort()
+
+    def is_stale(self) -> bool:
+        """True if the template file changed on disk since it was parsed"""
+        return os.path.getmtime(self.template_path) != self.mtime
+
+    def compile(self, input_data: list[models.InvoiceCells]) -> "CompiledXmlTemplate":
+        """Compiles the template for a batch of invoices, see CompiledXmlTemplate"""
+        with instrumentation.stage("compile_template") as counters:
+            constants = constant_fields(input_data)
+            counters["constant_fields"] = len(constants)
+        return CompiledXmlTemplate(self, constants)
+
+    def sheet_parts(
+        self, empty_rows: tuple[int, ...], constants: dict
+    ) -> list[str | tuple[str, str, str]]:
+        """
+        XML of the invoice sheet for the given empty account activity rows, as static
+        strings and (field, cell reference, style attribute) slots for the values that
+        differ per invoice. The constant fields are written into the static strings.
+        """
+        fields = {
+            cell: field
+            for field, cell in layout_coordinates(empty_rows).items()
+            if cell is not None
+        }
+        kept_rows = [
+            row
+            for row in range(ACTIVITY_ROWS.start, ACTIVITY_SECTION_END)
+            if row not in empty_rows
+        ]
+
+        parts = [self._sheet_head]
+        section = range(ACTIVITY_ROWS.start, ACTIVITY_SECTION_END)
+        for row in sorted(set(self._rows) | set(self._cells) | set(section)):
+            # cells move up over the removed rows and the rows added back at the end
+            # of the section are blank, while row heights stay, as in openpyxl
+            source_row = row
+            if row in section:
+                offset = row - section.start
+                source_row = kept_rows[offset] if offset < len(kept_rows) else None
+            cells = self._cells.get(source_row, [])
+            row_attrs = self._rows.get(row, "")
+            if not cells:
+                if row in self._rows:
+                    parts.append(f'<row r="{row}"{row_attrs}/>')
+                continue
+
+            parts.append(f'<row r="{row}"{row_attrs}>')
+            for column, letter, cell_attrs, cell_body in cells:
+                ref = f"{letter}{row}"
+                field = fields.get((row, column))
+                if field is None:
+                    if cell_body is None:
+                        parts.append(f'<c r="{ref}"{cell_attrs}/>')
+                    else:
+                        parts.append(f'<c r="{ref}"{cell_attrs}>{cell_body}</c>')
+                    continue
+                style = _STYLE_ATTR_RE.search(cell_attrs)
+                style = style.group(0) if style else ""
+                if field in constants:
+                    parts.append(cell_xml(ref, style, constants[field]))
+                else:
+                    parts.append((field, ref, style))
+            parts.append("</row>")
+        parts.append(self._sheet_tail)
+
+        merged = []
+        for part in parts:
+            if isinstance(part, str) and merged and isinstance(merged[-1], str):
+                merged[-1] += part
+            else:
+                merged.append(part)
+        return merged
+
+    def write_package(self, sheet: str) -> bytes:
+        """Returns the .xlsx file of the template with the given invoice sheet XML"""
+        buffer = BytesIO()
+        with zipfile.ZipFile(buffer, "w") as package:
+            for info, content in self._parts:
+                part = zipfile.ZipInfo(info.filename, info.date_time)
+                part.compress_type = info.compress_type
+                part.external_attr = info.external_attr
+                if info.filename == self.sheet_part:
+                    content = sheet.encode()
+                package.writestr(part, content)
+        return buffer.getvalue()
+
+
+class CompiledXmlTemplate:
+    """
+    XmlInvoiceTemplate compiled for one batch of invoices, with the fields that are
+    constant across the batch written into the sheet XML of each layout.
+    """
+
+    def __init__(self, template: XmlInvoiceTemplate, constants: dict):
+        self.template = template
+        self.constants = constants
+        self._sheet_parts: dict[tuple[int, ...], list[str | tuple[str, str, str]]] = {}
+
+    def render_bytes(self, invoice: models.InvoiceCells) -> bytes:
+        """Renders a single invoice and returns the content of its .xlsx file"""
+        empty_rows = empty_activity_rows(invoice)
+        parts = self._sheet_parts.get(empty_rows)
+        if parts is None:
+            parts = self.template.sheet_parts(empty_rows, self.constants)
+            self._sheet_parts[empty_rows] = parts
+        sheet = "".join(
+            part
+            if isinstance(part, str)
+            else cell_xml(part[1], part[2], invoice[part[0]])
+            for part in parts
+        )
+        return self.template.write_package(sheet)
+
+
+def cell_xml(ref: str, style: str, value) -> str:
+    """<c> element of a cell holding value, as openpyxl writes it"""
+    if value is None:
+        return f'<c r="{ref}"{style} t="n"/>'
+    if isinstance(value, (date, time)):
+        return f'<c r="{ref}"{style} t="n"><v>{safe_string(to_excel(value))}</v></c>'
+    if isinstance(value, NUMERIC_TYPES):
+        data_type = "b" if isinstance(value, bool) else "n"
+        return f'<c r="{ref}"{style} t="{data_type}"><v>{safe_string(value)}</v></c>'
+
+    text = str(value)[:32767]
+    if ILLEGAL_CHARACTERS_RE.search(text):
+        raise IllegalCharacterError(f"{text} cannot be used in worksheets.")
+    if len(text) > 1 and text.startswith("="):
+        return f'<c r="{ref}"{style}><f>{escape(text[1:])}</f><v></v></c>'
+    if text in ERROR_CODES:
+        return f'<c r="{ref}"{style} t="e"><v>{escape(text)}</v></c>'
+    if not text:
+        return f'<c r="{ref}"{style} t="inlineStr"/>'
+    space = ' xml:space="preserve"' if text.strip() and text != text.strip() else ""
+    return (
+        f'<c r="{ref}"{style} t="inlineStr"><is><t{space}>{escape(text)}</t></is></c>'
+    )
+
+
+def _sheet_part(package: zipfile.ZipFile, sheet_index: int) -> str:
+    """Path within the package of the XML of the sheet at sheet_index"""
+    workbook = ElementTree.fromstring(package.read("xl/workbook.xml"))
+    namespace = workbook.tag[: workbook.tag.index("}") + 1]
+    sheet = list(workbook.iter(f"{namespace}sheet"))[sheet_index]
+    relation_id = next(v for k, v in sheet.attrib.items() if k.endswith("}id"))
+
+    relations = ElementTree.fromstring(package.read("xl/_rels/workbook.xml.rels"))
+    target = next(r.get("Target") for r in relations if r.get("Id") == relation_id)
+    return target.lstrip("/") if target.startswith("/") else f"xl/{target}"
+
+
+RENDER_ENGINES = {"openpyxl": InvoiceTemplate, "xml": XmlInvoiceTemplate}
+
+_template_cache: dict[tuple[str, str], InvoiceTemplate | XmlInvoiceTemplate] = {}
+_template_cache_lock = Lock()
+
+
+def load_invoice_template(
+    template_path: str, engine: str = "openpyxl"
+) -> InvoiceTemplate | XmlInvoiceTemplate:
+    """Returns the parsed invoice template, parsing it at most once per process
+
+    The cached template is re-parsed when the modification time of the file changes.
+
+    Args:
+        template_path (str): local directory containing the template invoice file
+        engine (str, optional):
+            Render engine of RENDER_ENGINES to parse the template for: "openpyxl", or
+            "xml" to patch the sheet XML of the template directly, which is several
+            times faster. Defaults to "openpyxl".
+
+    Returns:
+        InvoiceTemplate | XmlInvoiceTemplate: parsed template to stamp invoices from
+    """
+    if engine not in RENDER_ENGINES:
+        raise ValueError(
+            f"Unknown render engine {engine!r}, expected one of {list(RENDER_ENGINES)}"
+        )
+    key = (os.path.abspath(template_path), engine)
+    with _template_cache_lock:
+        template = _template_cache.get(key)
+        if template is None or template.is_stale():
+            instrumentation.count("template_cache_misses")
+            template = RENDER_ENGINES[engine](template_path)
+            _template_cache[key] = template
+        else:
+            instrumentation.count("template_cache_hits")
+    return template
+
+
+# Invoice cells holding the day the invoices are generated on. They are left out of
+# the content hash so that an invoice whose data did not change is not re-rendered
+# only because it is regenerated on a later day.
+RUN_DATE_FIELDS = {"F3", "F36", "A13", "A14"}
+MANIFEST_FILE_NAME = ".invoice_manifest.json"
+MANIFEST_VERSION = 1
+
+
+def invoice_content_hash(invoice: models.InvoiceCells, template_hash: str) -> str:
+    """Hash of the data an invoice is rendered from, without its RUN_DATE_FIELDS"""
+    data = {k: v for k, v in invoice.items() if k not in RUN_DATE_FIELDS}
+    content = json.dumps([template_hash, data], sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+class InvoiceManifest:
+    """
+    Content hashes of the invoices saved in a directory, kept in MANIFEST_FILE_NAME
+    next to them, so that a regeneration only renders the invoices whose data
+    changed. Invoices are keyed by their path relative to the directory. A change of
+    the template invalidates every entry. Unless prune is False, the files of earlier
+    runs that are not part of the next saved run are deleted.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        template: InvoiceTemplate | XmlInvoiceTemplate,
+        prune: bool = True,
+    ):
+        self.directory = directory
+        self.template_hash = template.content_hash
+        self.prune = prune
+        self.hashes: dict[str, str] = {}
+        self._saved_files: set[str] = set()
+
+        try:
+            with open(os.path.join(directory, MANIFEST_FILE_NAME)) as f:
+                saved = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        self._saved_files = set(saved.get("invoices", {}))
+        if (
+            saved.get("version") == MANIFEST_VERSION
+            and saved.get("template") == self.template_hash
+        ):
+            self.hashes = saved["invoices"]
+
+    def is_current(self, file_name: str, content_hash: str) -> bool:
+        """True if file_name was saved from invoice data with content_hash"""
+        return self.hashes.get(file_name) == content_hash and os.path.isfile(
+            os.path.join(self.directory, file_name)
+        )
+
+    def changed(
+        self, input_data: list[models.InvoiceCells], file_names: list[str]
+    ) -> tuple[list[str], set[int]]:
+        """Returns the content hash of each invoice and the positions of those to render"""
+        content_hashes = [
+            invoice_content_hash(invoice, self.template_hash) for invoice in input_data
+        ]
+        changed = {
+            k
+            for k, (file_name, content_hash) in enumerate(
+                zip(file_names, content_hashes)
+            )
+            if not self.is_current(file_name, content_hash)
+        }
+        return content_hashes, changed
+
+    def save(self, written: dict[str, str]):
+        """
+        Records the invoices of a run, given as {file name: content hash}, and deletes
+        the files of earlier runs that are not part of it, if pruning
+        """
+        if self.prune:
+            self.hashes = dict(written)
+            for stale in self._saved_files - set(self.hashes):
+                stale_path = os.path.join(self.directory, stale)
+                if os.path.isfile(stale_path):
+                    os.unlink(stale_path)
+        else:
+            self.hashes.update(written)
+        self._saved_files = set(self.hashes)
+
+        manifest_path = os.path.join(self.directory, MANIFEST_FILE_NAME)
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump(
+                {
+                    "version": MANIFEST_VERSION,
+                    "template": self.template_hash,
+                    "invoices": self.hashes,
+                },
+                f,
+                indent=1,
+            )
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+
+class InvoiceRenderError(Exception):
+    """
+    Raised once a batch of invoices has been rendered if any of them failed. The
+    invoices that rendered successfully are saved and listed in export_file_paths
+    (their file names when rendered into a zip archive).
+    """
+
+    def __init__(self, failures: dict[str, str], export_file_paths: list[str]):
+        self.failures = failures
+        self.export_file_paths = export_file_paths
+        super().__init__(
+            f"{len(failures)} invoice(s) failed to render: " + ", ".join(failures)
+        )
+
+
+def remove_empty_rows(ws: Worksheet) -> Worksheet:
+    """
+    Takes a draft invoice in Worksheet format and returns the same with the empty rows
+    in the account activity section.
+    """
+    empty_rows = [i for i in ACTIVITY_ROWS if ws.cell(i, 3).value is None]
+    return remove_activity_rows(ws, empty_rows)
+
+
+def remove_activity_rows(ws: Worksheet, empty_rows: list[int]) -> Worksheet:
+    """
+    Removes the given account activity rows and adds blank rows back at the end of the
+    section, so that the rows below it keep their position.
+    """
+    index_row = list(empty_rows)
+    add_back_count = len(index_row)
+    add_back_start_row = ACTIVITY_SECTION_END - add_back_count
+
+    for row_del in range(len(index_row)):
+        ws.delete_rows(idx=index_row[row_del], amount=1)
+        index_row = [k - 1 for k in index_row]
+
+    # openpyxl's insert_rows with amount=0 deletes every cell below idx
+    if add_back_count:
+        ws.insert_rows(add_back_start_row, add_back_count)
+
+    return ws
+
+
+def invoice_file_name(invoice: models.InvoiceCells) -> str:
+    """File name of a composed invoice, e.g. 'ABC12 Bill Sep 2024.xlsx'"""
+    return f"{invoice['F4']} Bill {invoice['F6'].strftime('%b %Y')}.xlsx"
+
+
+def render_invoice(
+    template: InvoiceTemplate | CompiledTemplate, invoice: models.InvoiceCells
+) -> Workbook:
+    """
+    Stamps the invoice data onto a copy of the template layout matching the invoice's
+    empty account activity rows and returns the workbook. With a CompiledTemplate, only
+    the fields that are not constant across its batch are written.
+    """
+    layout = template.layout(empty_activity_rows(invoice))
+    wb = layout.new_workbook()
+    ws = wb.active
+    for field, row, column in layout.stamped_fields:
+        ws.cell(row, column).value = invoice[field]
+    return wb
+
+
+def render_invoice_bytes(
+    template: InvoiceTemplate | CompiledTemplate, invoice: models.InvoiceCells
+) -> bytes:
+    """Renders a single invoice and returns the content of its .xlsx file"""
+    wb = render_invoice(template, invoice)
+    buffer = BytesIO()
+    wb.save(buffer)
+    wb.close()
+    return buffer.getvalue()
+
+
+def write_invoice_file(
+    template: InvoiceTemplate | CompiledTemplate,
+    invoice: models.InvoiceCells,
+    export_file_path: str,
+) -> str:
+    """Renders a single invoice and saves it to export_file_path"""
+    wb = render_invoice(template, invoice)
+    wb.save(export_file_path)
+    wb.close()
+    return export_file_path
+
+
+_worker_template: CompiledTemplate | CompiledXmlTemplate | None = None
+
+
+def _init_render_worker(template: CompiledTemplate | CompiledXmlTemplate):
+    global _worker_template
+    _worker_template = template
+
+
+def _render_invoice_bytes_in_worker(invoice: models.InvoiceCells) -> bytes:
+    return _worker_template.render_bytes(invoice)
+
+
+def iter_rendered_invoices(
+    template: InvoiceTemplate | XmlInvoiceTemplate,
+    input_data: list[models.InvoiceCells],
+    workers: int = 1,
+) -> Iterator[tuple[models.InvoiceCells, bytes | None, str | None]]:
+    """Renders a batch of invoices, optionally across worker processes
+
+    Yields (invoice, content, error) in the order of input_data, where content is the
+    .xlsx file of the invoice, or None and error describes why it failed to render.
+    With workers, at most a few invoices per worker are rendered ahead of the consumer
+    so that memory stays bounded however large the batch is. The template is compiled
+    for the batch first, so fields constant across it are written once per layout.
+
+    Args:
+        template (InvoiceTemplate | XmlInvoiceTemplate):
+            parsed template to stamp the invoices from
+        input_data (list[models.InvoiceCells]): invoice data to populate the invoices
+        workers (int, optional):
+            Number of worker processes. Renders serially in the calling process if 1.
+            Defaults to 1.
+    """
+    template = template.compile(input_data)
+    if workers > 1 and len(input_data) > 1:
+        max_workers = min(workers, len(input_data))
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_render_worker,
+            initargs=(template,),
+        ) as executor:
+            pending = deque()
+            for invoice in input_data:
+                pending.append(
+                    (invoice, executor.submit(_render_invoice_bytes_in_worker, invoice))
+                )
+                if len(pending) >= max_workers * 4:
+                    yield _rendered_result(*pending.popleft())
+            while pending:
+                yield _rendered_result(*pending.popleft())
+    else:
+        for invoice in input_data:
+            try:
+                result = invoice, template.render_bytes(invoice), None
+            except Exception as e:
+                result = invoice, None, repr(e)
+            yield result
+
+
+def _rendered_result(invoice: models.InvoiceCells, future):
+    try:
+        return invoice, future.result(), None
+    except Exception as e:
+        return invoice, None, repr(e)
+
+
+def _iter_invoice_batch(
+    template: InvoiceTemplate | XmlInvoiceTemplate,
+    input_data: list[models.InvoiceCells],
+    file_names: list[str],
+    workers: int,
+    manifest: InvoiceManifest | None,
+    count_total: bool = True,
+) -> Iterator[tuple[models.InvoiceCells, str, bytes | None, str | None, str | None]]:
+    """
+    Yields (invoice, file_name, content, error, content_hash) in the order of
+    input_data. Only the invoices the manifest does not show as unchanged are
+    rendered; the others are yielded with neither content nor error. The batch is
+    added to the invoices_total counter unless count_total is False.
+    """
+    if count_total:
+        instrumentation.count("invoices_total", len(input_data))
+    content_hashes = [None] * len(input_data)
+    changed = range(len(input_data))
+    if manifest is not None:
+        content_hashes, changed = manifest.changed(input_data, file_names)
+        instrumentation.count("invoices_reused", len(input_data) - len(changed))
+
+    rendered = iter_rendered_invoices(
+        template, [input_data[k] for k in sorted(changed)], workers=workers
+    )
+    for k, (invoice, file_name) in enumerate(zip(input_data, file_names)):
+        if k in changed:
+            _, content, error = next(rendered)
+        else:
+            content, error = None, None
+        instrumentation.count("invoices_done")
+        yield invoice, file_name, content, error, content_hashes[k]
+
+
+def write_invoice_files(
+    template: InvoiceTemplate | XmlInvoiceTemplate,
+    input_data: list[models.InvoiceCells],
+    export_file_paths: list[str],
+    workers: int = 1,
+    manifest: InvoiceManifest | None = None,
+) -> list[str]:
+    """Renders and saves a batch of invoices, optionally across worker processes
+
+    The template snapshot is sent to each worker process once, when the pool starts.
+    A failing invoice does not abort the batch; failures are collected and raised as
+    an InvoiceRenderError after every invoice has been attempted.
+
+    Args:
+        template (InvoiceTemplate | XmlInvoiceTemplate):
+            parsed template to stamp the invoices from
+        input_data (list[models.InvoiceCells]): invoice data to populate the invoices
+        export_file_paths (list[str]): output path of each invoice in input_data
+        workers (int, optional):
+            Number of worker processes. Renders serially in the calling process if 1.
+            Defaults to 1.
+        manifest (InvoiceManifest | None, optional):
+            Manifest of the directory the invoices are saved in. Invoices whose file is
+            up to date are kept as they are instead of being rendered again, and files
+            of earlier runs that are not part of this one are deleted. Defaults to None.
+
+    Returns:
+        list[str]: paths of the saved invoice files, in the order of input_data
+    """
+    written = []
+    failures = {}
+    bytes_written = 0
+    saved = {}
+
+    file_names = export_file_paths
+    if manifest is not None:
+        file_names = [os.path.relpath(p, manifest.directory) for p in export_file_paths]
+    paths = dict(zip(file_names, export_file_paths))
+
+    for invoice, file_name, content, error, content_hash in _iter_invoice_batch(
+        template, input_data, file_names, workers, manifest
+    ):
+        if error is not None:
+            failures[invoice["F4"]] = error
+            continue
+        if content is not None:
+            with open(paths[file_name], "wb") as f:
+                f.write(content)
+            bytes_written += len(content)
+        written.append(paths[file_name])
+        saved[file_name] = content_hash
+
+    if manifest is not None:
+        manifest.save(saved)
+    instrumentation.count("invoices_written", len(written))
+    instrumentation.count("bytes_written", bytes_written)
+    if failures:
+        instrumentation.count("invoices_failed", len(failures))
+        raise InvoiceRenderError(failures=failures, export_file_paths=written)
+
+    return written
+
+
+def write_invoice_zip(
+    template: InvoiceTemplate | XmlInvoiceTemplate,
+    input_data: list[models.InvoiceCells],
+    zip_buffer: BinaryIO,
+    export_path: str | None = None,
+    workers: int = 1,
+    file_names: list[str] | None = None,
+    manifest: InvoiceManifest | None = None,
+) -> list[str]:
+    """Renders a batch of invoices straight into a zip archive
+
+    Each invoice is added to the archive as soon as it is rendered, without going
+    through an intermediate file, so only the archive and the invoices in flight are
+    held in memory. Failures are handled as in write_invoice_files; the archive is
+    still completed with the invoices that rendered. When file_names are given, the
+    failures are keyed by file name rather than by invoice id, as the ids of invoices
+    in different folders need not be unique.
+
+    Args:
+        template (InvoiceTemplate | XmlInvoiceTemplate):
+            parsed template to stamp the invoices from
+        input_data (list[models.InvoiceCells]): invoice data to populate the invoices
+        zip_buffer (BinaryIO): writable file-like object to write the archive to
+        export_path (str | None, optional):
+            Local directory to also save each invoice file in. Defaults to None.
+        workers (int, optional):
+            Number of worker processes. Renders serially in the calling process if 1.
+            Defaults to 1.
+        file_names (list[str] | None, optional):
+            Path of each invoice within the archive, e.g. to group them in folders.
+            Defaults to invoice_file_name of each invoice.
+        manifest (InvoiceManifest | None, optional):
+            Manifest of export_path. Invoices whose saved file is up to date are added
+            to the archive from that file instead of being rendered again, as in
+            write_invoice_files. Defaults to None.
+
+    Returns:
+        list[str]: file names of the invoices in the archive, in the order of input_data
+    """
+    keyed_by_file_name = file_names is not None
+    if file_names is None:
+        file_names = [invoice_file_name(i) for i in input_data]
+    if export_path is None:
+        manifest = None
+
+    written = []
+    failures = {}
+    bytes_written = 0
+    saved = {}
+
+    with zipfile.ZipFile(zip_buffer, "w") as zip_file:
+        for invoice, file_name, content, error, content_hash in _iter_invoice_batch(
+            template, input_data, file_names, workers, manifest
+        ):
+            if error is not None:
+                failures[file_name if keyed_by_file_name else invoice["F4"]] = error
+                continue
+            if content is None:
+                zip_file.write(os.path.join(export_path, file_name), arcname=file_name)
+            else:
+                zip_file.writestr(file_name, content)
+                if export_path is not None:
+                    export_file_path = os.path.join(export_path, file_name)
+                    os.makedirs(os.path.dirname(export_file_path), exist_ok=True)
+                    with open(export_file_path, "wb") as f:
+                        f.write(content)
+                bytes_written += len(content)
+            written.append(file_name)
+            saved[file_name] = content_hash
+
+    if manifest is not None:
+        manifest.save(saved)
+    instrumentation.count("invoices_written", len(written))
+    instrumentation.count("bytes_written", bytes_written)
+    if failures:
+        instrumentation.count("invoices_failed", len(failures))
+        raise InvoiceRenderError(failures=failures, export_file_paths=written)
+
+    return written
+
+
+def write_invoice_zip_chunks(
+    template: InvoiceTemplate | XmlInvoiceTemplate,
+    chunks: Iterable[list[models.InvoiceCells]],
+    zip_buffer: BinaryIO,
+    export_path: str | None = None,
+    workers: int = 1,
+    on_written: Callable[[list[models.InvoiceCells]], None] | None = None,
+    count_total: bool = True,
+) -> list[str]:
+    """Renders batches of invoices into one zip archive as they are produced
+
+    Same as write_invoice_zip over the invoices of all chunks, but each chunk is
+    compiled, rendered and added to the archive before the next one is taken from
+    chunks, so a lazily produced stream of chunks is never held in memory at once.
+    Failures are collected across chunks and raised once the stream is exhausted.
+
+    Args:
+        template (InvoiceTemplate | XmlInvoiceTemplate):
+            parsed template to stamp the invoices from
+        chunks (Iterable[list[models.InvoiceCells]]): batches of invoice data
+        zip_buffer (BinaryIO): writable file-like object to write the archive to
+        export_path (str | None, optional):
+            Local directory to also save each invoice file in. Defaults to None.
+        workers (int, optional):
+            Number of worker processes, started once per chunk. Renders serially in
+            the calling process if 1. Defaults to 1.
+        on_written (Callable[[list[models.InvoiceCells]], None] | None, optional):
+            Called once each chunk is done, with the invoices of the chunk that were
+            added to the archive. Defaults to None.
+        count_total (bool, optional):
+            Whether to add each chunk to the invoices_total counter as it is taken.
+            False if the producer of chunks counted the invoices up front, so that
+            the progress of the run is not reported as complete after each chunk.
+            Defaults to True.
+
+    Returns:
+        list[str]: file names of the invoices in the archive, in the order rendered
+    """
+    written = []
+    failures = {}
+    bytes_written = 0
+
+    with zipfile.ZipFile(zip_buffer, "w") as zip_file:
+        for input_data in chunks:
+            if not input_data:
+                continue
+            file_names = [invoice_file_name(i) for i in input_data]
+            chunk_written = []
+            for invoice, file_name, content, error, _ in _iter_invoice_batch(
+                template, input_data, file_names, workers, None, count_total
+            ):
+                if error is not None:
+                    failures[invoice["F4"]] = error
+                    continue
+                zip_file.writestr(file_name, content)
+                if export_path is not None:
+                    with open(os.path.join(export_path, file_name), "wb") as f:
+                        f.write(content)
+                bytes_written += len(content)
+                written.append(file_name)
+                chunk_written.append(invoice)
+            if on_written is not None:
+                on_written(chunk_written)
+
+    instrumentation.count("invoices_written", len(written))
+    instrumentation.count("bytes_written", bytes_written)
+    if failures:
+        instrumentation.count("invoices_failed", len(failures))
+        raise InvoiceRenderError(failures=failures, export_file_paths=written)
+
+    return written
+
+
+# Characters Excel does not allow in sheet titles, which are at most 31 characters
+INVALID_TITLE_CHARACTERS_RE = re.compile(r"[\\/*?:\[\]]")
+
+
+def invoice_sheet_title(invoice: models.InvoiceCells, taken: set[str]) -> str:
+    """
+    Title of an invoice's sheet in a multi-sheet workbook: its F4, made valid and
+    different from the titles in taken, which are compared case-insensitively as in
+    Excel. The title is added to taken.
+    """
+    title = INVALID_TITLE_CHARACTERS_RE.sub("_", str(invoice["F4"]))[:31] or "Invoice"
+    candidate = title
+    n = 1
+    while candidate.lower() in taken:
+        n += 1
+        suffix = f" ({n})"
+        candidate = title[: 31 - len(suffix)] + suffix
+    taken.add(candidate.lower())
+    return candidate
+
+
+def write_invoice_workbook(
+    template: InvoiceTemplate,
+    input_data: list[models.InvoiceCells],
+    output: str | BinaryIO,
+) -> list[str]:
+    """Renders a batch of invoices as the sheets of a single workbook
+
+    The invoice sheet of the template is copied once per invoice into one workbook,
+    titled by invoice_sheet_title, and each copy is compacted by remove_empty_rows.
+    The fields constant across the batch are written into the template sheet before
+    it is copied. The other sheets of the template follow the invoices and the
+    workbook is saved once. Failures are handled as in write_invoice_files; the
+    workbook is still saved with the invoices that rendered.
+
+    Args:
+        template (InvoiceTemplate): parsed template to stamp the invoices from
+        input_data (list[models.InvoiceCells]): invoice data to populate the invoices
+        output (str | BinaryIO): path or writable file-like object to save to
+
+    Returns:
+        list[str]: titles of the invoice sheets, in the order of input_data
+    """
+    wb = template.load_workbook()
+    statement = wb.active
+    other_sheets = [ws for ws in wb.worksheets if ws is not statement]
+    taken = {ws.title.lower() for ws in other_sheets}
+
+    coordinates = layout_coordinates(())
+    constants = constant_fields(input_data)
+    for field, value in constants.items():
+        statement.cell(*coordinates[field]).value = value
+    stamped_fields = [
+        (field, *cell) for field, cell in coordinates.items() if field not in constants
+    ]
+
+    instrumentation.count("invoices_total", len(input_data))
+    written = []
+    failures = {}
+    for invoice in input_data:
+        instrumentation.count("invoices_done")
+        ws = wb.copy_worksheet(statement)
+        try:
+            # copy_worksheet leaves out the views, conditional formats and footer
+            ws.views = copy.deepcopy(statement.views)
+            ws.HeaderFooter = copy.deepcopy(statement.HeaderFooter)
+            for conditional_format in statement.conditional_formatting:
+                for rule in conditional_format.rules:
+                    ws.conditional_formatting.add(str(conditional_format.sqref), rule)
+            for field, row, column in stamped_fields:
+                ws.cell(row, column).value = invoice[field]
+            remove_empty_rows(ws)
+            ws.title = invoice_sheet_title(invoice, taken)
+        except Exception as e:
+            wb.remove(ws)
+            failures[invoice["F4"]] = repr(e)
+            continue
+        written.append(ws.title)
+
+    wb.remove(statement)
+    for ws in other_sheets:
+        wb.move_sheet(ws, offset=len(wb.worksheets) - 1 - wb.index(ws))
+    wb.active = 0
+
+    with instrumentation.stage("save_workbook") as counters:
+        if isinstance(output, str):
+            wb.save(output)
+            counters["bytes"] = os.path.getsize(output)
+        else:
+            start = output.tell()
+            wb.save(output)
+            counters["bytes"] = output.tell() - start
+    wb.close()
+
+    instrumentation.count("invoices_written", len(written))
+    instrumentation.count("bytes_written", counters["bytes"])
+    if failures:
+        instrumentation.count("invoices_failed", len(failures))
+        raise InvoiceRenderError(failures=failures, export_file_paths=written)
+
+    return written
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+from datetime import date
+from datetime import datetime
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Schema metadata key of the original index and column labels of a cached frame
+LABELS_KEY = b"sheet_cache_labels"
+
+
+class SheetCache:
+    """
+    Parsed worksheets kept as files in a directory, so that a file uploaded again,
+    in another session or after a restart, is not read from .xlsx again. Entries
+    are keyed by cache_key and evicted least recently used first once the files of
+    the directory take more than max_bytes.
+
+    Frames are stored as Parquet files. The few that Parquet cannot give back as
+    they were, such as columns mixing numbers and the "" of empty cells, are pickled
+    instead. Files are written under a temporary name and renamed, so a cache can
+    be shared by the sessions and processes of the app.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 256 * 2**20):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    def _entry_paths(self, key: str) -> list[str]:
+        return [
+            os.path.join(self.path, f"{key}.parquet"),
+            os.path.join(self.path, f"{key}.pkl"),
+        ]
+
+    def get(self, key: str) -> pd.DataFrame | None:
+        """
+        Reads a cached frame and marks it as the most recently used. An entry that
+        cannot be read is removed and reported as not cached.
+
+        Args:
+            key (str): key of the entry, see cache_key
+
+        Returns:
+            pd.DataFrame | None: the cached frame, or None if it is not cached
+        """
+        parquet_path, pickle_path = self._entry_paths(key)
+        try:
+            if os.path.exists(parquet_path):
+                df = _read_parquet(parquet_path)
+                os.utime(parquet_path)
+            else:
+                with open(pickle_path, "rb") as f:
+                    df = pickle.load(f)
+                os.utime(pickle_path)
+        except FileNotFoundError:
+            # never cached, or evicted by another session in the meantime
+            return None
+        except Exception:
+            # truncated or unreadable, e.g. pickled by another version of pandas;
+            # dropped so the sheet is parsed and cached again
+            for path in (parquet_path, pickle_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            return None
+        return df
+
+    def put(self, key: str, df: pd.DataFrame) -> int:
+        """
+        Caches a frame, then evicts the least recently used entries until the cache
+        fits in max_bytes again. A frame larger than max_bytes is not cached.
+
+        Args:
+            key (str): key of the entry, see cache_key
+            df (pd.DataFrame): frame to cache
+
+        Returns:
+            int: size in bytes of the cached file, 0 if the frame was not cached
+        """
+        parquet_path, pickle_path = self._entry_paths(key)
+        table = _to_table(df)
+        path = parquet_path if table is not None else pickle_path
+        fd, temp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        os.close(fd)
+        if table is not None:
+            pq.write_table(table, temp_path)
+        else:
+            with open(temp_path, "wb") as f:
+                pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        size = os.path.getsize(temp_path)
+        if size > self.max_bytes:
+            os.remove(temp_path)
+            return 0
+        os.replace(temp_path, path)
+        self.evict()
+        return size
+
+    def evict(self) -> list[str]:
+        """
+        Removes the least recently used entries until the cache fits in max_bytes.
+
+        Returns:
+            list[str]: file names of the removed entries
+        """
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith((".parquet", ".pkl")):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.name))
+
+        total = sum(size for _, size, _ in entries)
+        removed = []
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed.append(name)
+        return removed
+
+
+def cache_key(file_hash: str, *parts) -> str:
+    """
+    Key of a cache entry: the content hash of the file and the parts that decide
+    how it was parsed, e.g. the parser version, the sheet name and the engine.
+    """
+    return hashlib.sha256(
+        json.dumps([file_hash, *parts], default=str).encode()
+    ).hexdigest()
+
+
+def _to_table(df: pd.DataFrame) -> pa.Table | None:
+    """
+    The frame as an Arrow table whose columns are named after their position, with
+    the original labels kept in the schema metadata. None if Parquet would not give
+    the frame back as it is.
+    """
+    columns = [df.index, *(df.iloc[:, i] for i in range(df.shape[1]))]
+    for column in columns:
+        if column.dtype == object and not all(isinstance(v, str) for v in column):
+            return None
+    try:
+        labels = json.dumps(
+            [_encode_label(df.index.name), [_encode_label(c) for c in df.columns]]
+        )
+    except TypeError:
+        return None
+
+    flat = pd.DataFrame(
+        {str(i): pd.Series(column).to_numpy() for i, column in enumerate(columns)}
+    )
+    try:
+        table = pa.Table.from_pandas(flat, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return None
+    return table.replace_schema_metadata(
+        {**table.schema.metadata, LABELS_KEY: labels.encode()}
+    )
+
+
+def _read_parquet(path: str) -> pd.DataFrame:
+    table = pq.read_table(path)
+    index_name, column_labels = json.loads(table.schema.metadata[LABELS_KEY])
+    df = table.to_pandas().set_index("0")
+    df.index.name = _decode_label(index_name)
+    df.columns = [_decode_label(label) for label in column_labels]
+    return df
+
+
+def _encode_label(label):
+    if isinstance(label, datetime):
+        return {"datetime": label.isoformat()}
+    if isinstance(label, date):
+        return {"date": label.isoformat()}
+    if label is None or isinstance(label, (str, int, float)):
+        return label
+    raise TypeError(f"Cannot store the label {label!r}")
+
+
+def _decode_label(label):
+    if isinstance(label, dict):
+        if "datetime" in label:
+            return datetime.fromisoformat(label["datetime"])
+        return date.fromisoformat(label["date"])
+    return label
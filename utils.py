@@ -1,52 +1,49 @@
 import base64
 import csv
+import hashlib
 import os
 import re
 import shutil
+import time
 import zipfile
+from collections import OrderedDict
+from collections.abc import Iterator
 from datetime import date
 from datetime import datetime
 from datetime import timedelta
 from io import BytesIO
+from itertools import islice
+from threading import Lock
+from typing import BinaryIO
 from uuid import UUID
+from xml.etree import ElementTree
 
 import numpy as np
 import pandas as pd
-import streamlit as st
-from dateutil.relativedelta import relativedelta
 from openpyxl import load_workbook
-from openpyxl.worksheet.worksheet import Worksheet
-from pydantic import ValidationError
+from openpyxl.cell.cell import ERROR_CODES
+from pandas.io.parsers import TextParser
+from pydantic import TypeAdapter
 
 import data_models as models
+import instrumentation
 from config import BusinessEntityParams
-
-
-def statement_date_widget() -> date:
-    """
-    Sets the statement date for the session that the user is working on. The function
-    creates Streamlit number input widgets to take user input for a year and month to
-    return the first of the selected month as date object.
-    """
-    st.sidebar.write("Select the statement date to work on:")
-    year = st.sidebar.number_input(
-        label="Year",
-        min_value=2020,
-        max_value=2100,
-        value=(date.today() + relativedelta(months=1)).year,
-    )
-    month = st.sidebar.number_input(
-        label="Month",
-        min_value=1,
-        max_value=12,
-        value=(date.today() + relativedelta(months=1)).month,
-    )
-    selected_date = date(year, month, 1)
-
-    if st.session_state.statement_date != selected_date:
-        st.session_state.statement_date = selected_date
-
-    return selected_date
+from invoice_ledger import DISPLAY_COLUMNS
+from invoice_ledger import InvoiceLedger
+from rendering import InvoiceManifest
+from rendering import InvoiceRenderError
+from rendering import InvoiceTemplate
+from rendering import XmlInvoiceTemplate
+from rendering import invoice_file_name
+from rendering import load_invoice_template
+from rendering import remove_empty_rows  # noqa: F401
+from rendering import write_invoice_files
+from rendering import write_invoice_workbook
+from rendering import write_invoice_zip
+from rendering import write_invoice_zip_chunks
+from sheet_cache import SheetCache
+from sheet_cache import cache_key
+from water_store import WaterReadingStore
 
 
 def get_properties() -> list[dict]:
@@ -67,112 +64,468 @@ def get_properties() -> list[dict]:
         print("Property file not found")
 
 
-def properties_widget(properties: list[dict]) -> dict:
-    """Returns a widget that allows user to set the session property to work with
+def extract_lot_number(lot_id: str | None) -> int | None:
+    """Formatting function for composing invoices"""
+    if lot_id:
+        return int(re.sub(r"\D", "", lot_id))
+    else:
+        return lot_id
+
+
+def as_invoice_cells(
+    input_data: list[models.InvoiceCells | models.InvoiceFileParse],
+) -> list[models.InvoiceCells]:
+    """Dumps the InvoiceFileParse instances of input_data into the cells they render"""
+    return [
+        i.model_dump() if isinstance(i, models.InvoiceFileParse) else i
+        for i in input_data
+    ]
+
+
+def generate_invoices(
+    template_path: str,
+    input_data: list[models.InvoiceCells | models.InvoiceFileParse],
+    export_path: str,
+    template: InvoiceTemplate | XmlInvoiceTemplate | None = None,
+    workers: int = 1,
+    incremental: bool = False,
+    partial: bool = False,
+    render_engine: str = "openpyxl",
+):
+    """Generates and saves invoices locally
+
+    Invoices that fail to render do not stop the rest of the batch. Once every invoice
+    has been attempted, an InvoiceRenderError listing the failures is raised.
 
     Args:
-        properties (list[dict]): List of properties available in the database
+        template_path (str): local directory containing the template invoice file
+        input_data (list[models.InvoiceCells | models.InvoiceFileParse]):
+            invoice data to populate the invoices
+        export_path (str): local directory to save the composed invoice files
+        template (InvoiceTemplate | XmlInvoiceTemplate | None, optional):
+            Already parsed template to stamp the invoices from. If None, the template at
+            template_path is parsed once per process and reused. Defaults to None.
+        workers (int, optional):
+            Number of worker processes rendering the invoices. Invoices are rendered
+            serially in the calling process if 1. Defaults to 1.
+        incremental (bool, optional):
+            Keep the invoices saved in export_path by an earlier run whose data did
+            not change instead of rendering them again, as recorded in its
+            InvoiceManifest. Defaults to False.
+        partial (bool, optional):
+            input_data is only part of the invoices saved in export_path, e.g. a few
+            corrected lots. With incremental, the saved invoices that are not part of
+            input_data are kept instead of being deleted. Defaults to False.
+        render_engine (str, optional):
+            Render engine to parse the template for if template is None, see
+            load_invoice_template. Defaults to "openpyxl".
 
     Returns:
-        dict: Dict form of a property object
+        list[str]: paths of the saved invoice files, in the order of input_data
     """
-    st.session_state.prop = st.sidebar.selectbox(
-        "Select the invoice configuration",
-        options=properties,
-        format_func=lambda x: x["property_code"],
+    if template is None:
+        template = load_invoice_template(template_path, engine=render_engine)
+    input_data = as_invoice_cells(input_data)
+
+    export_file_paths = [f"{export_path}{invoice_file_name(i)}" for i in input_data]
+    return write_invoice_files(
+        template=template,
+        input_data=input_data,
+        export_file_paths=export_file_paths,
+        workers=workers,
+        manifest=(
+            InvoiceManifest(export_path, template, prune=not partial)
+            if incremental
+            else None
+        ),
     )
 
-    return st.session_state.prop
 
+def generate_invoice_zip(
+    template_path: str,
+    input_data: list[models.InvoiceCells | models.InvoiceFileParse],
+    zip_buffer: BinaryIO,
+    export_path: str | None = None,
+    template: InvoiceTemplate | XmlInvoiceTemplate | None = None,
+    workers: int = 1,
+    incremental: bool = False,
+    partial: bool = False,
+    render_engine: str = "openpyxl",
+) -> list[str]:
+    """Generates invoices straight into a zip archive, without intermediate files
+
+    Failures are handled as in generate_invoices. The archive is still completed with
+    the invoices that rendered, and the InvoiceRenderError raised lists their names.
 
-def extract_lot_number(lot_id: str | None) -> int | None:
-    """Formatting function for composing invoices"""
-    if lot_id:
-        return int(re.sub(r"\D", "", lot_id))
-    else:
-        return lot_id
+    Args:
+        template_path (str): local directory containing the template invoice file
+        input_data (list[models.InvoiceCells | models.InvoiceFileParse]):
+            invoice data to populate the invoices
+        zip_buffer (BinaryIO): writable file-like object to write the archive to
+        export_path (str | None, optional):
+            Local directory to also save the composed invoice files in. Nothing is
+            written to disk if None. Defaults to None.
+        template (InvoiceTemplate | XmlInvoiceTemplate | None, optional):
+            Already parsed template to stamp the invoices from. If None, the template at
+            template_path is parsed once per process and reused. Defaults to None.
+        workers (int, optional):
+            Number of worker processes rendering the invoices. Invoices are rendered
+            serially in the calling process if 1. Defaults to 1.
+        incremental (bool, optional):
+            Keep the invoices saved in export_path by an earlier run whose data did
+            not change instead of rendering them again, as recorded in its
+            InvoiceManifest. Defaults to False.
+        partial (bool, optional):
+            input_data is only part of the invoices saved in export_path, e.g. a few
+            corrected lots. With incremental, the saved invoices that are not part of
+            input_data are kept instead of being deleted. Defaults to False.
+        render_engine (str, optional):
+            Render engine to parse the template for if template is None, see
+            load_invoice_template. Defaults to "openpyxl".
+
+    Returns:
+        list[str]: file names of the invoices in the archive, in the order of input_data
+    """
+    if template is None:
+        template = load_invoice_template(template_path, engine=render_engine)
+    input_data = as_invoice_cells(input_data)
+
+    return write_invoice_zip(
+        template=template,
+        input_data=input_data,
+        zip_buffer=zip_buffer,
+        export_path=export_path,
+        workers=workers,
+        manifest=(
+            InvoiceManifest(export_path, template, prune=not partial)
+            if incremental and export_path is not None
+            else None
+        ),
+    )
+
+
+def generate_invoice_workbook(
+    template_path: str,
+    input_data: list[models.InvoiceCells | models.InvoiceFileParse],
+    output: str | BinaryIO,
+    template: InvoiceTemplate | None = None,
+) -> list[str]:
+    """Generates the invoices as the sheets of a single workbook, e.g. for printing
 
+    Each invoice gets a sheet titled by its F4, compacted as its own file would be,
+    and the workbook is saved once. The workbook is always built with the openpyxl
+    engine. Failures are handled as in generate_invoices; the workbook is still saved
+    with the invoices that rendered.
 
-def remove_empty_rows(ws: Worksheet) -> Worksheet:
+    Args:
+        template_path (str): local directory containing the template invoice file
+        input_data (list[models.InvoiceCells | models.InvoiceFileParse]):
+            invoice data to populate the invoices
+        output (str | BinaryIO): path or writable file-like object to save to
+        template (InvoiceTemplate | None, optional):
+            Already parsed template to copy the invoice sheets from. If None, the
+            template at template_path is parsed once per process and reused. Defaults
+            to None.
+
+    Returns:
+        list[str]: titles of the invoice sheets, in the order of input_data
     """
-    Takes a draft invoice in Worksheet format and returns the same with the empty rows
-    in the account activity section.
+    if template is None:
+        template = load_invoice_template(template_path)
+
+    return write_invoice_workbook(
+        template=template, input_data=as_invoice_cells(input_data), output=output
+    )
+
+
+def read_excel_columns(
+    file: BytesIO,
+    usecols: list[int],
+    header: int,
+    sheet_name: str | int = 0,
+    engine: str | None = None,
+) -> pd.DataFrame:
     """
-    index_row = []
-    add_back_count = 0
-    add_back_start_row = 31
+    Reads only the usecols columns of a worksheet into a DataFrame, with the first of
+    usecols as the index. The result is the same as that of pd.read_excel with
+    index_col=0 followed by selecting the columns.
 
-    for i in range(13, 21):
-        if ws.cell(i, 3).value is None:
-            index_row.append(i)
-            add_back_count += 1
-            add_back_start_row -= 1
+    By default the rows are streamed through openpyxl's read-only mode and only the
+    used cells are converted and kept, so memory scales with the number of columns
+    used rather than with the size of the sheet. Any engine supported by pd.read_excel
+    can be passed instead, e.g. "calamine" when python-calamine is installed. A
+    sheet given by position is then passed to it by name, as not every engine
+    accepts negative positions.
 
-    for row_del in range(len(index_row)):
-        ws.delete_rows(idx=index_row[row_del], amount=1)
-        index_row = [k - 1 for k in index_row]
+    Args:
+        file (BytesIO): uploaded .xlsx file
+        usecols (list[int]): zero-based positions of the columns to read
+        header (int): zero-based row number of the column labels
+        sheet_name (str | int, optional):
+            Name or position of the worksheet. Defaults to the first worksheet.
+        engine (str | None, optional):
+            pd.read_excel engine to read with. If None, rows are streamed with
+            openpyxl. Defaults to None.
 
-    ws.insert_rows(add_back_start_row, add_back_count)
+    Returns:
+        pd.DataFrame: used columns of the worksheet
+    """
+    if engine is not None:
+        if isinstance(sheet_name, int):
+            sheet_names = list_excel_sheet_names(file)
+            if not -len(sheet_names) <= sheet_name < len(sheet_names):
+                raise ValueError(f"Worksheet at position {sheet_name} not found")
+            sheet_name = sheet_names[sheet_name]
+        return pd.read_excel(
+            file,
+            header=header,
+            index_col=0,
+            sheet_name=sheet_name,
+            usecols=usecols,
+            engine=engine,
+        )
 
-    return ws
+    rows = _iter_used_rows(file, usecols, sheet_name)
+    return TextParser(
+        list(rows), header=header, index_col=0, skip_blank_lines=False
+    ).read()
 
 
-def generate_invoices(
-    template_path: str,
-    input_data: list[models.InvoiceFileParse],
-    export_path: str,
-):
-    """Generates and saves invoices locally
+def iter_excel_column_chunks(
+    file: BytesIO,
+    usecols: list[int],
+    header: int,
+    chunk_rows: int,
+    sheet_name: str | int = 0,
+    engine: str | None = None,
+) -> Iterator[pd.DataFrame]:
+    """
+    Same as read_excel_columns, but yields the rows below the header chunk_rows at a
+    time, so only one chunk of the sheet is held in memory. With an engine, the whole
+    sheet is read by pd.read_excel first and then split.
 
     Args:
-        template_path (str): local directory containing the template invoice file
-        input_data (list[models.InvoiceFileParse]): invoice data to populate the invoices
-        export_path (str): local directory to save the composed invoice files
+        file (BytesIO): uploaded .xlsx file
+        usecols (list[int]): zero-based positions of the columns to read
+        header (int): zero-based row number of the column labels
+        chunk_rows (int): number of rows per chunk
+        sheet_name (str | int, optional):
+            Name or position of the worksheet. Defaults to the first worksheet.
+        engine (str | None, optional):
+            pd.read_excel engine to read with. If None, rows are streamed with
+            openpyxl. Defaults to None.
+
+    Yields:
+        pd.DataFrame: consecutive rows of the used columns of the worksheet
+    """
+    if engine is not None:
+        df = read_excel_columns(file, usecols, header, sheet_name, engine)
+        for start in range(0, len(df), chunk_rows):
+            yield df.iloc[start : start + chunk_rows]
+        return
 
-    Returns:
-        _type_: _description_
-    """
-    export_file_paths = []
-    for i in input_data:
-        wb = load_workbook(template_path)
-        ws = wb.active
-        model = i.model_dump()
-        for k, v in model.items():
-            ws[k] = v
-        ws = remove_empty_rows(ws)
-        export_file_path = f"{export_path}{i.F4} Bill {i.F6.strftime('%b %Y')}.xlsx"
-        export_file_paths.append(export_file_path)
-        wb.save(export_file_path)
+    rows = _iter_used_rows(file, usecols, sheet_name)
+    labels = None
+    for row_number, row in enumerate(rows):
+        if row_number == header:
+            labels = row
+            break
+    if labels is None:
+        return
+
+    while chunk := list(islice(rows, chunk_rows)):
+        yield TextParser(
+            [labels, *chunk], header=0, index_col=0, skip_blank_lines=False
+        ).read()
+
+
+def _iter_used_rows(
+    file: BytesIO, usecols: list[int], sheet_name: str | int
+) -> Iterator[list]:
+    """
+    Streams the usecols cells of each row of a worksheet through openpyxl's read-only
+    mode, converted as pandas' openpyxl reader does: empty cells read as "", error
+    cells as NaN, whole floats as int, and trailing empty rows of the sheet are
+    dropped. Raises a ValueError once the sheet is exhausted if it is narrower than
+    usecols.
+    """
+    wb = load_workbook(file, read_only=True, data_only=True, keep_links=False)
+    try:
+        if isinstance(sheet_name, str):
+            if sheet_name not in wb.sheetnames:
+                raise ValueError(f"Worksheet named '{sheet_name}' not found")
+            ws = wb[sheet_name]
+        else:
+            ws = wb.worksheets[sheet_name]
+        ws.reset_dimensions()
+
+        width = 0
+        # rows without any data are held back until a row with data follows them
+        empty_rows = []
+        for row in ws.iter_rows(values_only=True):
+            row_width = len(row)
+            while row_width and row[row_width - 1] is None:
+                row_width -= 1
+
+            converted_row = []
+            for i in usecols:
+                value = row[i] if i < row_width else None
+                if value is None:
+                    converted_row.append("")
+                elif isinstance(value, str) and value in ERROR_CODES:
+                    converted_row.append(np.nan)
+                elif isinstance(value, float) and value.is_integer():
+                    converted_row.append(int(value))
+                else:
+                    converted_row.append(value)
+
+            if not row_width:
+                empty_rows.append(converted_row)
+                continue
+            width = max(width, row_width)
+            yield from empty_rows
+            empty_rows.clear()
+            yield converted_row
+    finally:
         wb.close()
-    return export_file_paths
+
+    if max(usecols) >= width:
+        raise ValueError(
+            f"Expected at least {max(usecols) + 1} columns, the sheet has {width}"
+        )
 
 
-def ingest_water_meter_readings(report_file: BytesIO) -> pd.DataFrame:
+def ingest_water_meter_readings(
+    report_file: BytesIO, engine: str | None = None, previous_optional: bool = False
+) -> pd.DataFrame:
     """Ingests water usage report in .xlsx format from user and returns as pd.DataFrame
 
+    Only the lot, name, meter number and the two reading columns are read.
+
     Args:
         report_file (BytesIO): uploaded water meter report
+        engine (str | None, optional):
+            pd.read_excel engine to read with. If None, the rows are streamed with
+            openpyxl. Defaults to None.
+        previous_optional (bool, optional):
+            Accept a report of current readings only, whose previous reading column
+            has no date; that column is then labelled None. Its readings are taken
+            from a WaterReadingStore instead. Defaults to False.
     """
-    df = pd.read_excel(report_file, header=1, index_col=0)
+    df = read_excel_columns(
+        report_file, usecols=[0, 1, 2, 3, 4], header=1, engine=engine
+    )
     try:
         previous_date = df.columns[3]
         current_date = df.columns[2]
-        assert isinstance(previous_date, date)
+        assert isinstance(previous_date, date) or previous_optional
         assert isinstance(current_date, date)
-        if isinstance(previous_date, datetime) and isinstance(current_date, datetime):
-            df.rename(
-                columns={
-                    df.columns[3]: df.columns[3].date(),
-                    df.columns[2]: df.columns[2].date(),
-                },
-                inplace=True,
-            )
+        if not isinstance(previous_date, date):
+            previous_date = None
+        elif isinstance(previous_date, datetime):
+            previous_date = previous_date.date()
+        if isinstance(current_date, datetime):
+            current_date = current_date.date()
+        df.columns = [*df.columns[:2], current_date, previous_date, *df.columns[4:]]
     except AssertionError as e:
         raise (e)
 
     return df
 
 
+def ingest_water_meter_readings_cached(
+    report_file: BytesIO,
+    engine: str | None = None,
+    previous_optional: bool = False,
+    sheet_cache: SheetCache | None = None,
+) -> pd.DataFrame:
+    """
+    Same as ingest_water_meter_readings, but looks the report up in the sheet_cache
+    by its content hash before reading it, and keeps it there once read.
+    """
+    if sheet_cache is None:
+        return ingest_water_meter_readings(report_file, engine, previous_optional)
+
+    key = cache_key(
+        file_content_hash(report_file),
+        "water",
+        PARSER_VERSION,
+        engine,
+        previous_optional,
+    )
+    df = sheet_cache.get(key)
+    if df is not None:
+        instrumentation.count("sheet_cache_hits")
+        return df
+
+    instrumentation.count("sheet_cache_misses")
+    df = ingest_water_meter_readings(report_file, engine, previous_optional)
+    sheet_cache.put(key, df)
+    return df
+
+
+def validate_water_usage_report(
+    report: pd.DataFrame, statement_date: date | None = None
+) -> models.WaterUsageReport:
+    """
+    Validates every reading pair of a water usage report at once and returns the valid
+    readings column-wise, indexed by lot, together with a report of the invalid rows.
+    The checks are the same as those of the WaterUsage model: meter numbers and
+    readings must be whole numbers and the current reading cannot be less than the
+    previous reading.
+
+    Args:
+        report (pd.DataFrame):
+            Water usage report as returned by ingest_water_meter_readings
+        statement_date (date | None, optional):
+            The statement date to assign to the water usages. If None, the statement
+            date will set to the first day of current month. Defaults to None.
+
+    Returns:
+        models.WaterUsageReport: valid readings indexed by lot and the invalid rows
+    """
+    if not statement_date:
+        statement_date = date.today().replace(day=1)
+
+    readings = pd.DataFrame(
+        {
+            "watermeter_id": pd.to_numeric(report["Meter #"], errors="coerce"),
+            "previous_reading": pd.to_numeric(report.iloc[:, 3], errors="coerce"),
+            "current_reading": pd.to_numeric(report.iloc[:, 2], errors="coerce"),
+        },
+        index=report.index,
+    )
+
+    whole = np.isfinite(readings) & (readings == np.floor(readings))
+    descending = readings["current_reading"] < readings["previous_reading"]
+    invalid = ~whole.all(axis=1) | descending
+
+    errors = []
+    for n, row in readings[invalid].iterrows():
+        reasons = [
+            f"{k} is missing or not a whole number"
+            for k in whole.columns
+            if not whole.at[n, k]
+        ]
+        if descending.at[n]:
+            reasons.append("Current reading cannot be less than previous reading")
+        errors.append(
+            models.WaterReadingError(
+                lot_id=n if isinstance(n, (int, np.integer)) else str(n),
+                **{k: None if np.isnan(v) else v for k, v in row.items()},
+                reason="; ".join(reasons),
+            )
+        )
+
+    return models.WaterUsageReport(
+        previous_date=report.columns[3],
+        current_date=report.columns[2],
+        statement_date=statement_date,
+        readings=readings[~invalid].astype("int64"),
+        errors=errors,
+    )
+
+
 def generate_water_usage_objects(
     report: pd.DataFrame, statement_date: date | None = None, indexed: bool = False
 ) -> list[models.WaterUsage] | dict[int, models.WaterUsage]:
@@ -188,84 +541,248 @@ def generate_water_usage_objects(
     Returns:
         list[models.WaterUsage]: composed WaterUsage objects
     """
-    if not statement_date:
-        statement_date = date.today().replace(day=1)
+    usage_report = validate_water_usage_report(report, statement_date)
 
-    water_usages = []
-    if indexed:
-        water_usages = {}
+    if usage_report.errors:
+        return [e.lot_id for e in usage_report.errors]
 
-    check_list = []
+    if indexed:
+        return {n: usage_report[n] for n in usage_report.readings.index}
+
+    return [
+        models.WaterUsage(
+            watermeter_id=row.watermeter_id,
+            previous_date=usage_report.previous_date,
+            current_date=usage_report.current_date,
+            statement_date=usage_report.statement_date,
+            previous_reading=row.previous_reading,
+            current_reading=row.current_reading,
+        )
+        for row in usage_report.readings.itertuples()
+    ]
 
-    previous_date = report.columns[3]
-    current_date = report.columns[2]
 
-    for n, row in report.iterrows():
-        try:
-            water_usage = models.WaterUsage(
-                watermeter_id=row["Meter #"],
-                previous_date=previous_date,
-                current_date=current_date,
-                statement_date=statement_date,
-                previous_reading=row.iloc[3],
-                current_reading=row.iloc[2],
-            )
-            if indexed:
-                water_usages[n] = water_usage
-            else:
-                water_usages.append(water_usage)
-        except ValidationError:
-            check_list.append(row.name)
+def list_excel_sheet_names(book: BytesIO) -> list[str]:
+    """
+    Lists the worksheet names of an .xlsx file in workbook order by reading only the
+    workbook part of the package. No sheet data is parsed, so this is near instant
+    even for large multi-sheet books.
 
-    if check_list:
-        return check_list
+    Args:
+        book (BytesIO): uploaded .xlsx file
 
-    return water_usages
+    Returns:
+        list[str]: worksheet names, the last of which is ingested by default
+    """
+    position = book.tell()
+    book.seek(0)
+    with zipfile.ZipFile(book) as package:
+        root = ElementTree.fromstring(package.read("xl/workbook.xml"))
+    book.seek(position)
+
+    namespace = root.tag[: root.tag.index("}") + 1] if root.tag[0] == "{" else ""
+    return [sheet.get("name") for sheet in root.iter(f"{namespace}sheet")]
+
+
+# Lot column and the 22 columns of a bookkeeping sheet used for invoicing
+BOOK_USECOLS = [0] + [i + 1 for i in range(27) if i not in [1, 9, 15, 23, 25]]
+BOOK_COLUMNS = [
+    "tenant_name",
+    "starting_balance",
+    "monthly_due_last_month",
+    "paid_on_time_last_month",
+    "paid_past_due_last_month",
+    "late_fee_accrued_last_month",
+    "total_carried_over_last_month",
+    "ending_balance",
+    "monthly_rent",
+    "monthly_storage",
+    "monthly_water",
+    "monthly_other",
+    "new_charges_this_month",
+    "payment_on_time_1",
+    "payment_on_time_2",
+    "payment_on_time_3",
+    "payment_overdue_1",
+    "payment_overdue_2",
+    "payment_overdue_3",
+    "payment_overdue_4",
+    "late_fee_this_month",
+    "carry_over_to_next_month",
+]
 
 
 def ingest_bookkeeping_excel(
-    book: BytesIO, sheet_name: str | None = None
+    book: BytesIO, sheet_name: str | None = None, engine: str | None = None
 ) -> pd.DataFrame:
     """Ingests bookkeeping file in .xlsx format from user and returns as pd.DataFrame
 
+    Only the lot column and the 22 columns used for invoicing are read.
+
     Args:
         report_file (BytesIO): uploaded bookkeeping file
+        sheet_name (str | None, optional):
+            Name of the worksheet to ingest. If None, the last worksheet is ingested.
+        engine (str | None, optional):
+            pd.read_excel engine to read with. If None, the rows are streamed with
+            openpyxl. Defaults to None.
     """
-    if sheet_name:
-        df = pd.read_excel(book, header=2, index_col=0, sheet_name=sheet_name)
-    else:
-        df = pd.read_excel(book, header=2, index_col=0, sheet_name=-1)
-
-    drop_col_idx = [1, 9, 15, 23, 25]
-    out_df = df.iloc[:, [i for i in range(len(df.columns)) if i not in drop_col_idx]]
-    out_df.columns = [
-        "tenant_name",
-        "starting_balance",
-        "monthly_due_last_month",
-        "paid_on_time_last_month",
-        "paid_past_due_last_month",
-        "late_fee_accrued_last_month",
-        "total_carried_over_last_month",
-        "ending_balance",
-        "monthly_rent",
-        "monthly_storage",
-        "monthly_water",
-        "monthly_other",
-        "new_charges_this_month",
-        "payment_on_time_1",
-        "payment_on_time_2",
-        "payment_on_time_3",
-        "payment_overdue_1",
-        "payment_overdue_2",
-        "payment_overdue_3",
-        "payment_overdue_4",
-        "late_fee_this_month",
-        "carry_over_to_next_month",
-    ]
+    out_df = read_excel_columns(
+        book,
+        usecols=BOOK_USECOLS,
+        header=2,
+        sheet_name=sheet_name if sheet_name else -1,
+        engine=engine,
+    )
+    out_df.columns = BOOK_COLUMNS
 
     return out_df
 
 
+def read_book_lots(
+    book: BytesIO, sheet_name: str | None = None, engine: str | None = None
+) -> list[int]:
+    """Lot numbers of a bookkeeping sheet, reading only its lot column
+
+    Args:
+        book (BytesIO): uploaded bookkeeping file
+        sheet_name (str | None, optional):
+            Name of the worksheet to read. If None, the last worksheet is read.
+        engine (str | None, optional):
+            pd.read_excel engine to read with. If None, the rows are streamed with
+            openpyxl. Defaults to None.
+
+    Returns:
+        list[int]: lot numbers in the order of the sheet, without the rows whose lot
+        is not a number
+    """
+    lot_column = read_excel_columns(
+        book,
+        usecols=BOOK_USECOLS[:1],
+        header=2,
+        sheet_name=sheet_name if sheet_name else -1,
+        engine=engine,
+    )
+    lot_numbers = pd.to_numeric(lot_column.index, errors="coerce").dropna()
+    return lot_numbers.astype(int).tolist()
+
+
+def iter_bookkeeping_excel_chunks(
+    book: BytesIO,
+    chunk_rows: int,
+    sheet_name: str | None = None,
+    engine: str | None = None,
+) -> Iterator[pd.DataFrame]:
+    """Same as ingest_bookkeeping_excel, but yields the lots chunk_rows at a time
+
+    Args:
+        book (BytesIO): uploaded bookkeeping file
+        chunk_rows (int): number of rows per chunk
+        sheet_name (str | None, optional):
+            Name of the worksheet to ingest. If None, the last worksheet is ingested.
+        engine (str | None, optional):
+            pd.read_excel engine to read with. If None, the rows are streamed with
+            openpyxl. Defaults to None.
+
+    Yields:
+        pd.DataFrame: consecutive rows of the ingested bookkeeping sheet
+    """
+    for chunk in iter_excel_column_chunks(
+        book,
+        usecols=BOOK_USECOLS,
+        header=2,
+        chunk_rows=chunk_rows,
+        sheet_name=sheet_name if sheet_name else -1,
+        engine=engine,
+    ):
+        chunk.columns = BOOK_COLUMNS
+        yield chunk
+
+
+# Version of the output of the ingest functions, part of the SheetCache keys so that
+# sheets cached by an earlier version are parsed again. Increase it when that output
+# changes.
+PARSER_VERSION = 1
+
+_book_cache: OrderedDict[tuple[str, str | int], pd.DataFrame] = OrderedDict()
+_book_cache_lock = Lock()
+
+
+def file_content_hash(file: BytesIO) -> str:
+    """Returns the SHA-256 hex digest of an uploaded file's content"""
+    if isinstance(file, BytesIO):
+        return hashlib.sha256(file.getbuffer()).hexdigest()
+
+    position = file.tell()
+    file.seek(0)
+    digest = hashlib.sha256(file.read()).hexdigest()
+    file.seek(position)
+    return digest
+
+
+def ingest_bookkeeping_excel_cached(
+    book: BytesIO,
+    sheet_name: str | None = None,
+    max_entries: int = 8,
+    engine: str | None = None,
+    sheet_cache: SheetCache | None = None,
+) -> pd.DataFrame:
+    """
+    Same as ingest_bookkeeping_excel, but keeps the parsed sheets of the most recently
+    used uploads in memory. Entries are keyed by the content hash of the upload and
+    the sheet name, so Streamlit reruns and the invoice generation step reuse the
+    frame parsed for an upload instead of reading the .xlsx file again. With a
+    sheet_cache, a sheet missing from memory is looked up on disk before it is read,
+    and kept there once read, so it survives the session and restarts of the app.
+
+    Args:
+        book (BytesIO): uploaded bookkeeping file
+        sheet_name (str | None, optional):
+            Name of the worksheet to ingest. If None, the last worksheet is ingested.
+        max_entries (int, optional):
+            Number of parsed sheets to keep before evicting the least recently used.
+            Defaults to 8.
+        engine (str | None, optional):
+            pd.read_excel engine to read with. If None, the rows are streamed with
+            openpyxl. Defaults to None.
+        sheet_cache (SheetCache | None, optional):
+            Disk cache of parsed sheets shared across sessions. Defaults to None.
+
+    Returns:
+        pd.DataFrame: copy of the ingested bookkeeping sheet
+    """
+    file_hash = file_content_hash(book)
+    key = (file_hash, sheet_name or -1)
+
+    with _book_cache_lock:
+        if key in _book_cache:
+            _book_cache.move_to_end(key)
+            instrumentation.count("book_cache_hits")
+            return _book_cache[key].copy()
+
+    instrumentation.count("book_cache_misses")
+
+    df = None
+    if sheet_cache is not None:
+        disk_key = cache_key(file_hash, "book", PARSER_VERSION, sheet_name, engine)
+        df = sheet_cache.get(disk_key)
+        instrumentation.count(
+            "sheet_cache_hits" if df is not None else "sheet_cache_misses"
+        )
+    if df is None:
+        df = ingest_bookkeeping_excel(book=book, sheet_name=sheet_name, engine=engine)
+        if sheet_cache is not None:
+            sheet_cache.put(disk_key, df)
+
+    with _book_cache_lock:
+        _book_cache[key] = df
+        _book_cache.move_to_end(key)
+        while len(_book_cache) > max_entries:
+            _book_cache.popitem(last=False)
+
+    return df.copy()
+
+
 def serialize_invoice_input_from_book_ingest(
     company: BusinessEntityParams,
     statement_date: date,
@@ -429,60 +946,744 @@ def serialize_invoice_input_from_book_ingest(
     return parsed
 
 
-def generate_invoice_from_user_inputs(
+def serialize_invoice_inputs_from_book_frame(
+    company: BusinessEntityParams,
+    statement_date: date,
+    property_code: str,
+    street_address_base: str,
+    csz_address: str,
+    book_df: pd.DataFrame,
+    waters: models.WaterUsageReport | None,
+) -> list[dict]:
+    """
+    Batch version of serialize_invoice_input_from_book_ingest. Computes the invoice
+    fields column-wise over the whole ingested book and returns the parsed invoice
+    inputs of every lot with a non-zero amount due, in book order.
+
+    The book is validated the same way as BookIngest, once per column rather than
+    once per row.
+
+    Args:
+        company (BusinessEntityParams): landlord information listed on the invoices
+        statement_date (date): statement date of the invoices
+        property_code (str): property code prefixed to the lot numbers
+        street_address_base (str): street address of the property
+        csz_address (str): city, state and zip code of the property
+        book_df (pd.DataFrame):
+            Bookkeeping sheet as returned by ingest_bookkeeping_excel
+        waters (models.WaterUsageReport | None):
+            Validated water usage report. If None, no water charges are listed.
+
+    Returns:
+        list[dict]: parsed invoice inputs to populate InvoiceFileParse with
+    """
+    amount_fields = [
+        k for k, v in models.BookIngest.model_fields.items() if v.annotation is float
+    ]
+    lot_ids = np.array(TypeAdapter(list[int]).validate_python(book_df.index.tolist()))
+    tenant_names = np.array(
+        TypeAdapter(list[str]).validate_python(book_df["tenant_name"].tolist()),
+        dtype=object,
+    )
+    amounts = {k: book_df[k].to_numpy(dtype=float) for k in amount_fields}
+
+    if waters is not None:
+        check_water_readings(waters, lot_ids.tolist())
+        water_readings = waters.readings[
+            ~waters.readings.index.duplicated(keep="last")
+        ].loc[lot_ids]
+
+    total_amount_due = amounts["ending_balance"] + amounts["new_charges_this_month"]
+    invoiced = total_amount_due != 0
+    if not invoiced.any():
+        return []
+
+    lot_ids = lot_ids[invoiced]
+    tenant_names = tenant_names[invoiced]
+    amounts = {k: v[invoiced] for k, v in amounts.items()}
+    total_amount_due = total_amount_due[invoiced]
+    if waters is not None:
+        water_readings = water_readings[invoiced]
+
+    def labels(present: np.ndarray, value) -> list:
+        return np.where(present, value, None).tolist()
+
+    customer_ids = [property_code + str(lot_number) for lot_number in lot_ids]
+    tenant_address_1 = [
+        str(lot_number) + " " + street_address_base for lot_number in lot_ids
+    ]
+
+    amt_overdue = np.where(
+        amounts["total_carried_over_last_month"] >= 0,
+        amounts["starting_balance"],
+        amounts["starting_balance"] + amounts["total_carried_over_last_month"],
+    )
+    prev_mth_total_amount_paid = (
+        amounts["paid_on_time_last_month"] + amounts["paid_past_due_last_month"]
+    )
+    prev_mth_residual = amounts["monthly_due_last_month"] - prev_mth_total_amount_paid
+
+    prev_month = statement_date - timedelta(days=28)
+    date_now = models.et_date_now()
+
+    columns = {
+        "invoice_customer_id": customer_ids,
+        "tenant_address_1": tenant_address_1,
+        "tenant_name": tenant_names.tolist(),
+        "amt_prev_month_paid": prev_mth_total_amount_paid.tolist(),
+        "amt_prev_month_residual": np.where(
+            0 > prev_mth_residual, 0, prev_mth_residual
+        ).tolist(),
+        "invoice_total_amount_due": total_amount_due.tolist(),
+        "amt_total_amount_due": total_amount_due.tolist(),
+        "amt_overdue": amt_overdue.tolist(),
+        "amt_other_rent": amounts["monthly_other"].tolist(),
+        "amt_rent": amounts["monthly_rent"].tolist(),
+        "amt_storage": amounts["monthly_storage"].tolist(),
+        "amt_late_fee": amounts["late_fee_accrued_last_month"].tolist(),
+    }
+
+    if waters is not None:
+        previous_reading = water_readings["previous_reading"].to_numpy()
+        current_reading = water_readings["current_reading"].to_numpy()
+        columns["amt_water"] = amounts["monthly_water"].tolist()
+        columns["water_bill_period"] = columns["amt_water"]
+        columns["water_prev_read"] = previous_reading.tolist()
+        columns["water_curr_read"] = current_reading.tolist()
+        columns["water_meter_id"] = water_readings["watermeter_id"].tolist()
+        columns["water_usage_period"] = (current_reading - previous_reading).tolist()
+
+    has_late_fee = ~np.isnan(amounts["late_fee_accrued_last_month"])
+    has_rent = ~np.isnan(amounts["monthly_rent"])
+    has_storage = ~np.isnan(amounts["monthly_storage"])
+    has_paid = ~np.isnan(prev_mth_total_amount_paid)
+    has_other = ~np.isnan(amounts["monthly_other"])
+
+    columns["desc_late_fee"] = labels(has_late_fee, "Late fee")
+    columns["date_late"] = labels(has_late_fee, statement_date)
+    columns["desc_curr_rent"] = labels(
+        has_rent, f"Lot rent for {statement_date.strftime('%B %Y')}"
+    )
+    columns["date_rent"] = labels(has_rent, statement_date)
+    columns["desc_curr_storage"] = labels(
+        has_storage, f"Storage rent for {statement_date.strftime('%B %Y')}"
+    )
+    columns["date_storage"] = labels(has_storage, statement_date)
+    columns["desc_prev_month_paid"] = labels(
+        has_paid, f"Bill paid for {prev_month.strftime('%B %Y')}"
+    )
+    columns["date_today_1"] = labels(has_paid, date_now)
+    columns["desc_prev_overdue"] = labels(amt_overdue != 0, "Previous overdue (credit)")
+    columns["desc_other_rent"] = labels(has_other, "Other rent(s)*")
+    columns["date_other_rent"] = labels(has_other, statement_date)
+    columns["detail_other_rent"] = labels(
+        has_other, "* Please contact to find out the details"
+    )
+
+    constants = {
+        "tenant_address_2": csz_address if csz_address else "",
+        "amt_water": 0,
+        "water_bill_period": None,
+        "water_prev_read": None,
+        "water_curr_read": None,
+        "water_curr_date": None,
+        "water_prev_date": None,
+        "water_meter_id": None,
+        "desc_curr_water": None,
+        "date_water": None,
+        "water_usage_period": None,
+        "desc_prev_month_residual": f"{prev_month.strftime('%B')} bill, less paid",
+        "date_today_2": date_now,
+        "invoice_date": date_now,
+        "business_name": company.business_name,
+        "business_address_1": company.business_address_1,
+        "business_address_2": company.business_address_2,
+        "business_contact_phone": company.business_contact_phone,
+        "business_contact_email": company.business_contact_email,
+        "invoice_due_date": statement_date,
+        "business_name_": company.business_name.upper(),
+        "business_address_1_": company.business_address_1,
+        "business_address_2_": company.business_address_2,
+        "business_contact_email_": f"Or Zelle to {company.business_contact_email}",
+        "invoice_date_": date_now,
+        "invoice_due_date_": statement_date,
+    }
+    if waters is not None:
+        constants["water_curr_date"] = waters.current_date
+        constants["water_prev_date"] = waters.previous_date
+        constants["desc_curr_water"] = (
+            f"Water bill for {waters.previous_date.strftime('%B')}-"
+            + f"{waters.current_date.strftime('%B %Y')}"
+        )
+        constants["date_water"] = statement_date
+
+    columns["invoice_customer_id_"] = columns["invoice_customer_id"]
+    columns["invoice_total_amount_due_"] = columns["invoice_total_amount_due"]
+
+    keys = list(columns)
+    return [
+        {**constants, **dict(zip(keys, values))} for values in zip(*columns.values())
+    ]
+
+
+def select_lots(df: pd.DataFrame, lots: list[int] | None) -> pd.DataFrame:
+    """Returns the rows of a frame indexed by lot whose lot number is one of lots
+
+    Args:
+        df (pd.DataFrame): ingested book or water report
+        lots (list[int] | None): lot numbers to keep. All rows are kept if None.
+
+    Returns:
+        pd.DataFrame: the selected rows, in the order of df
+    """
+    if lots is None:
+        return df
+    return df[pd.to_numeric(df.index, errors="coerce").isin(lots)]
+
+
+def check_lots_in_book(lots: list[int] | None, book_lots) -> None:
+    """Raises a ValueError naming the lots to invoice that are not in the book"""
+    missing = set(lots or ()) - set(book_lots)
+    if missing:
+        raise ValueError(
+            f"Lot(s) {', '.join(map(str, sorted(missing)))} not in the book"
+        )
+
+
+def check_water_readings(waters: models.WaterUsageReport, lot_ids: list[int]) -> None:
+    """
+    Raises a ValueError listing the invalid water readings of lot_ids, or the lots
+    of lot_ids the water report has no reading for, if any
+    """
+    errors = waters.errors_for(lot_ids)
+    if errors:
+        raise ValueError(
+            "Invalid water readings for lot(s) "
+            + ", ".join(f"{e.lot_id} ({e.reason})" for e in errors)
+        )
+    missing = set(lot_ids) - set(waters.readings.index)
+    if missing:
+        raise ValueError(
+            f"No water readings for lot(s) {', '.join(map(str, sorted(missing)))}"
+        )
+
+
+def build_invoices_from_user_inputs(
     book: BytesIO,
     waters: BytesIO | None,
     statement_date: date,
     prop: dict,
-    template_path: str,
-    export_path: str,
     sheet_name: str | None = None,
     company: BusinessEntityParams | None = None,
-):
+    excel_engine: str | None = None,
+    lots: list[int] | None = None,
+    water_store: WaterReadingStore | None = None,
+    sheet_cache: SheetCache | None = None,
+) -> list[models.InvoiceCells]:
+    """Reads the uploaded book and water report into the invoices of a property
+
+    Args:
+        book (BytesIO): uploaded bookkeeping file
+        waters (BytesIO | None): uploaded water report, if any
+        statement_date (date): statement date of the invoices
+        prop (dict): property to invoice, in models.Property form
+        sheet_name (str | None, optional):
+            Name of the worksheet to ingest. If None, the last worksheet is ingested.
+        company (BusinessEntityParams | None, optional):
+            Landlord listed on the invoices. Read from the .env file if None.
+        excel_engine (str | None, optional):
+            pd.read_excel engine to read with. If None, the rows are streamed with
+            openpyxl. Defaults to None.
+        lots (list[int] | None, optional):
+            Lot numbers to invoice. Only these rows of the book and water report are
+            validated, serialized and turned into invoices. Defaults to all lots.
+        water_store (WaterReadingStore | None, optional):
+            Store to record the readings of the water report in. The meters without
+            a previous reading, e.g. in a report of current readings only, get the
+            last reading stored before the report's date. Defaults to None.
+        sheet_cache (SheetCache | None, optional):
+            Disk cache to take the parsed book and water report from, if they
+            were read before, and to keep them in otherwise. Defaults to None.
+
+    Returns:
+        list[models.InvoiceCells]: validated invoice data, one per invoiced lot
+    """
     if company is None:
         company = BusinessEntityParams()
 
     prop = models.Property.model_validate(prop)
 
-    book_df = ingest_bookkeeping_excel(book=book, sheet_name=sheet_name)
-    book_dict = book_df.to_dict(orient="index")
+    with instrumentation.stage("ingest_book") as stage:
+        book_df = ingest_bookkeeping_excel_cached(
+            book=book,
+            sheet_name=sheet_name,
+            engine=excel_engine,
+            sheet_cache=sheet_cache,
+        )
+        stage["rows"] = len(book_df)
+        if lots is not None:
+            book_df = select_lots(book_df, lots)
+            check_lots_in_book(lots, pd.to_numeric(book_df.index, errors="coerce"))
+            stage["selected_rows"] = len(book_df)
 
+    water_report = None
     if waters:
-        water_df = ingest_water_meter_readings(waters)
-        water_usages = generate_water_usage_objects(
-            water_df, statement_date, indexed=True
+        water_report = read_water_usage_report(
+            waters, statement_date, excel_engine, lots, water_store, sheet_cache
         )
-        input_data = [
-            serialize_invoice_input_from_book_ingest(
-                company=company,
-                statement_date=statement_date,
-                property_code=prop.property_code,
-                street_address_base=prop.street_address,
-                csz_address=prop.city_state_zip,
-                entry=models.BookIngest(lot_id=lot_number, **entry),
-                water=water_usages[lot_number],
+
+    return _invoices_from_book_frame(
+        book_df, water_report, statement_date, prop, company
+    )
+
+
+def iter_invoice_chunks(
+    book: BytesIO,
+    waters: BytesIO | None,
+    statement_date: date,
+    prop: dict,
+    chunk_size: int,
+    sheet_name: str | None = None,
+    company: BusinessEntityParams | None = None,
+    excel_engine: str | None = None,
+    lots: list[int] | None = None,
+    water_store: WaterReadingStore | None = None,
+    sheet_cache: SheetCache | None = None,
+) -> Iterator[list[models.InvoiceCells]]:
+    """Streaming version of build_invoices_from_user_inputs
+
+    Returns an iterator over the invoices of the book chunk_size rows at a time.
+    Each chunk is only read, joined with the water readings, serialized and
+    validated when the consumer asks for it, so only one chunk of the book is held
+    in memory besides the validated water readings. The lots to invoice are added to
+    the invoices_total counter up front, and the lots of each chunk that are not
+    invoiced, e.g. with nothing due, are taken off it once the chunk is serialized,
+    so the progress of the run holds across chunks. The water report, the lots and
+    their water readings are checked before the iterator is returned, reading only
+    the lot column of the book, so these errors are raised before anything is
+    rendered, as with build_invoices_from_user_inputs. The sheet_cache only serves
+    the water report, as caching the book would mean holding all of it.
+
+    Args:
+        chunk_size (int): number of book rows per chunk
+        Other arguments are those of build_invoices_from_user_inputs.
+
+    Returns:
+        Iterator[list[models.InvoiceCells]]: validated invoice data of the invoiced
+        lots of each chunk
+    """
+    if company is None:
+        company = BusinessEntityParams()
+
+    prop = models.Property.model_validate(prop)
+
+    with instrumentation.stage("check_lots") as stage:
+        book_lots = read_book_lots(book, sheet_name, engine=excel_engine)
+        stage["rows"] = len(book_lots)
+        check_lots_in_book(lots, book_lots)
+
+    water_report = None
+    if waters:
+        water_report = read_water_usage_report(
+            waters, statement_date, excel_engine, lots, water_store, sheet_cache
+        )
+        check_water_readings(water_report, lots if lots is not None else book_lots)
+
+    instrumentation.count(
+        "invoices_total", len(lots) if lots is not None else len(book_lots)
+    )
+    return _iter_invoice_chunks(
+        book,
+        chunk_size,
+        sheet_name,
+        excel_engine,
+        lots,
+        water_report,
+        statement_date,
+        prop,
+        company,
+    )
+
+
+def _iter_invoice_chunks(
+    book: BytesIO,
+    chunk_size: int,
+    sheet_name: str | None,
+    excel_engine: str | None,
+    lots: list[int] | None,
+    water_report: models.WaterUsageReport | None,
+    statement_date: date,
+    prop: models.Property,
+    company: BusinessEntityParams,
+) -> Iterator[list[models.InvoiceCells]]:
+    chunks = iter_bookkeeping_excel_chunks(
+        book, chunk_size, sheet_name=sheet_name, engine=excel_engine
+    )
+    while True:
+        with instrumentation.stage("ingest_book") as stage:
+            book_df = next(chunks, None)
+            if book_df is None:
+                break
+            stage["rows"] = len(book_df)
+            if lots is not None:
+                book_df = select_lots(book_df, lots)
+                stage["selected_rows"] = len(book_df)
+
+        invoices = _invoices_from_book_frame(
+            book_df, water_report, statement_date, prop, company
+        )
+        chunk_lots = pd.to_numeric(book_df.index, errors="coerce").notna().sum()
+        instrumentation.count("invoices_total", len(invoices) - int(chunk_lots))
+        yield invoices
+
+
+def read_water_usage_report(
+    waters: BytesIO,
+    statement_date: date,
+    excel_engine: str | None = None,
+    lots: list[int] | None = None,
+    water_store: WaterReadingStore | None = None,
+    sheet_cache: SheetCache | None = None,
+) -> models.WaterUsageReport:
+    """
+    Reads and validates an uploaded water report, recording its readings in and
+    completing it from the water_store if one is given, see
+    build_invoices_from_user_inputs
+    """
+    with instrumentation.stage("ingest_water") as stage:
+        water_df = ingest_water_meter_readings_cached(
+            waters,
+            engine=excel_engine,
+            previous_optional=water_store is not None,
+            sheet_cache=sheet_cache,
+        )
+        stage["rows"] = len(water_df)
+    if water_store is not None:
+        with instrumentation.stage("water_store") as stage:
+            stage["added"], stage["updated"] = water_store.ingest_report(water_df)
+            water_df, stage["filled"] = water_store.fill_previous_readings(water_df)
+    water_df = select_lots(water_df, lots)
+    with instrumentation.stage("water_objects") as stage:
+        water_report = validate_water_usage_report(water_df, statement_date)
+        stage["rows"] = len(water_report.readings)
+        stage["invalid_rows"] = len(water_report.errors)
+    return water_report
+
+
+def _invoices_from_book_frame(
+    book_df: pd.DataFrame,
+    water_report: models.WaterUsageReport | None,
+    statement_date: date,
+    prop: models.Property,
+    company: BusinessEntityParams,
+) -> list[models.InvoiceCells]:
+    with instrumentation.stage("serialize") as stage:
+        input_data = serialize_invoice_inputs_from_book_frame(
+            company=company,
+            statement_date=statement_date,
+            property_code=prop.property_code,
+            street_address_base=prop.street_address,
+            csz_address=prop.city_state_zip,
+            book_df=book_df,
+            waters=water_report,
+        )
+        stage["rows"] = len(book_df)
+        stage["invoices"] = len(input_data)
+
+    with instrumentation.stage("invoice_models") as stage:
+        invoice_parsed = models.validate_invoice_cells(input_data)
+        stage["invoices"] = len(invoice_parsed)
+
+    return invoice_parsed
+
+
+def record_written_invoices(
+    ledger: InvoiceLedger | None,
+    property_code: str,
+    statement_date: date,
+    input_data: list[models.InvoiceCells],
+    failed=(),
+):
+    """
+    Records the invoices of a property that were written in the ledger, if any,
+    leaving out the failed invoice ids, so the ledger only lists issued invoices
+    """
+    if ledger is None:
+        return
+    with instrumentation.stage("ledger") as stage:
+        stage["invoices"] = ledger.record(
+            property_code,
+            statement_date,
+            [invoice for invoice in input_data if invoice["F4"] not in failed],
+        )
+
+
+def generate_invoice_from_user_inputs(
+    book: BytesIO,
+    waters: BytesIO | None,
+    statement_date: date,
+    prop: dict,
+    template_path: str,
+    export_path: str | None,
+    sheet_name: str | None = None,
+    company: BusinessEntityParams | None = None,
+    workers: int = 1,
+    excel_engine: str | None = None,
+    zip_buffer: BinaryIO | None = None,
+    incremental: bool = False,
+    lots: list[int] | None = None,
+    render_engine: str = "openpyxl",
+    workbook: BinaryIO | None = None,
+    water_store: WaterReadingStore | None = None,
+    ledger: InvoiceLedger | None = None,
+    chunk_size: int | None = None,
+    sheet_cache: SheetCache | None = None,
+):
+    """Generates the invoices of a property from the uploaded book and water report
+
+    The invoices are saved in export_path, or rendered straight into zip_buffer if
+    one is given, in which case export_path is optional. With incremental, only the
+    invoices whose data changed since the last run into export_path are rendered.
+    With lots, only the invoices of those lot numbers are generated; the other
+    invoices already saved in export_path are left as they are. render_engine selects
+    the render engine of load_invoice_template. If a workbook is given, the invoices
+    are instead saved into it as the sheets of a single workbook, see
+    generate_invoice_workbook, and export_path and zip_buffer are ignored. With a
+    water_store, the water readings are recorded in and completed from it, and with
+    a sheet_cache the parsed book and water report are taken from and kept in it,
+    see build_invoices_from_user_inputs. With a ledger, the data of the invoices that
+    were written is recorded in it once they are, leaving out the failed ones.
+    With a chunk_size and a zip_buffer, the lots flow from the book into the archive
+    chunk_size at a time, see iter_invoice_chunks and write_invoice_zip_chunks, so
+    memory does not grow with the size of the book; incremental is then ignored.
+
+    Returns:
+        list[str]: paths of the saved invoice files, the file names of the invoices in
+        the archive when zip_buffer is given, or the sheet titles with a workbook
+    """
+    property_code = prop["property_code"]
+    if chunk_size is not None and zip_buffer is not None and workbook is None:
+        chunks = iter_invoice_chunks(
+            book=book,
+            waters=waters,
+            statement_date=statement_date,
+            prop=prop,
+            chunk_size=chunk_size,
+            sheet_name=sheet_name,
+            company=company,
+            excel_engine=excel_engine,
+            lots=lots,
+            water_store=water_store,
+            sheet_cache=sheet_cache,
+        )
+        with instrumentation.stage("stream") as stage:
+            stage["chunk_size"] = chunk_size
+            template = load_invoice_template(template_path, engine=render_engine)
+            return write_invoice_zip_chunks(
+                template=template,
+                chunks=chunks,
+                zip_buffer=zip_buffer,
+                export_path=export_path,
+                workers=workers,
+                on_written=lambda written: record_written_invoices(
+                    ledger, property_code, statement_date, written
+                ),
+                count_total=False,
             )
-            for lot_number, entry in book_dict.items()
-        ]
-    else:
-        input_data = [
-            serialize_invoice_input_from_book_ingest(
-                company=company,
+
+    invoice_parsed = build_invoices_from_user_inputs(
+        book=book,
+        waters=waters,
+        statement_date=statement_date,
+        prop=prop,
+        sheet_name=sheet_name,
+        company=company,
+        excel_engine=excel_engine,
+        lots=lots,
+        water_store=water_store,
+        sheet_cache=sheet_cache,
+    )
+
+    try:
+        with instrumentation.stage("render") as stage:
+            stage["invoices"] = len(invoice_parsed)
+            if workbook is not None:
+                written = generate_invoice_workbook(
+                    template_path=template_path,
+                    input_data=invoice_parsed,
+                    output=workbook,
+                )
+            elif zip_buffer is not None:
+                written = generate_invoice_zip(
+                    template_path=template_path,
+                    input_data=invoice_parsed,
+                    zip_buffer=zip_buffer,
+                    export_path=export_path,
+                    workers=workers,
+                    incremental=incremental,
+                    partial=lots is not None,
+                    render_engine=render_engine,
+                )
+            else:
+                written = generate_invoices(
+                    template_path=template_path,
+                    input_data=invoice_parsed,
+                    export_path=export_path,
+                    workers=workers,
+                    incremental=incremental,
+                    partial=lots is not None,
+                    render_engine=render_engine,
+                )
+    except InvoiceRenderError as e:
+        record_written_invoices(
+            ledger, property_code, statement_date, invoice_parsed, e.failures
+        )
+        raise
+
+    record_written_invoices(ledger, property_code, statement_date, invoice_parsed)
+    return written
+
+
+def generate_property_batch_zip(
+    batch: dict[str, dict],
+    properties: list[dict],
+    statement_date: date,
+    template_path: str,
+    zip_buffer: BinaryIO,
+    export_path: str | None = None,
+    company: BusinessEntityParams | None = None,
+    workers: int = 1,
+    excel_engine: str | None = None,
+    incremental: bool = False,
+    render_engine: str = "openpyxl",
+    water_store: WaterReadingStore | None = None,
+    ledger: InvoiceLedger | None = None,
+    sheet_cache: SheetCache | None = None,
+) -> dict[str, models.PropertyBatchResult]:
+    """Generates the invoices of several properties into one zip archive
+
+    The invoices of every property are read first and then rendered in one pass, so
+    the parsed template and the worker pool are shared by all properties. Each
+    property's invoices are placed in a folder named after its property code. A
+    property whose book or water report cannot be read is reported and skipped
+    without affecting the others.
+
+    Args:
+        batch (dict[str, dict]):
+            Inputs of each property code to invoice: its "book", optionally the
+            "sheet_name" to ingest (the last worksheet if missing), the "waters"
+            report and the "lots" to invoice (all if missing). Several properties
+            can share a book with different sheets.
+        properties (list[dict]): properties listed by get_properties
+        statement_date (date): statement date of the invoices
+        template_path (str): local directory containing the template invoice file
+        zip_buffer (BinaryIO): writable file-like object to write the archive to
+        export_path (str | None, optional):
+            Local directory to also save the invoices in, one folder per property.
+            Defaults to None.
+        company (BusinessEntityParams | None, optional):
+            Landlord listed on the invoices. Read from the .env file if None.
+        workers (int, optional):
+            Number of worker processes rendering the invoices. Defaults to 1.
+        excel_engine (str | None, optional):
+            pd.read_excel engine to read with. Defaults to None.
+        incremental (bool, optional):
+            Keep the invoices saved in export_path by an earlier run whose data did
+            not change instead of rendering them again, as recorded in its
+            InvoiceManifest. Defaults to False.
+        render_engine (str, optional):
+            Render engine to parse the template for, see load_invoice_template.
+            Defaults to "openpyxl".
+        water_store (WaterReadingStore | None, optional):
+            Store to record the water readings of every property in and to take the
+            missing previous readings from. Defaults to None.
+        ledger (InvoiceLedger | None, optional):
+            Ledger to record the data of the invoices written for every property
+            in, once the archive is complete. Defaults to None.
+        sheet_cache (SheetCache | None, optional):
+            Disk cache of the parsed books and water reports. Defaults to None.
+
+    Returns:
+        dict[str, models.PropertyBatchResult]: outcome of each property code of batch
+    """
+    if company is None:
+        company = BusinessEntityParams()
+    properties_by_code = {p["property_code"]: p for p in properties or []}
+
+    results = {}
+    input_data = []
+    file_names = []
+    invoice_properties = {}
+    for property_code, inputs in batch.items():
+        result = models.PropertyBatchResult(property_code=property_code)
+        results[property_code] = result
+        try:
+            if property_code not in properties_by_code:
+                raise KeyError(f"Property {property_code} is not listed")
+            invoices = build_invoices_from_user_inputs(
+                book=inputs["book"],
+                waters=inputs.get("waters"),
                 statement_date=statement_date,
-                property_code=prop.property_code,
-                street_address_base=prop.street_address,
-                csz_address=prop.city_state_zip,
-                entry=models.BookIngest(lot_id=lot_number, **entry),
-                water=None,
+                prop=properties_by_code[property_code],
+                sheet_name=inputs.get("sheet_name"),
+                company=company,
+                excel_engine=excel_engine,
+                lots=inputs.get("lots"),
+                water_store=water_store,
+                sheet_cache=sheet_cache,
             )
-            for lot_number, entry in book_dict.items()
-        ]
+        except Exception as e:
+            result.error = repr(e)
+            continue
+
+        for invoice in invoices:
+            file_name = f"{property_code}/{invoice_file_name(invoice)}"
+            invoice_properties[file_name] = property_code
+            file_names.append(file_name)
+        input_data.extend(invoices)
+
+    written = []
+    failures = {}
+    with instrumentation.stage("render") as stage:
+        stage["invoices"] = len(input_data)
+        template = load_invoice_template(template_path, engine=render_engine)
+        try:
+            written = write_invoice_zip(
+                template=template,
+                input_data=input_data,
+                zip_buffer=zip_buffer,
+                export_path=export_path,
+                workers=workers,
+                file_names=file_names,
+                manifest=(
+                    InvoiceManifest(
+                        export_path,
+                        template,
+                        prune=all(i.get("lots") is None for i in batch.values()),
+                    )
+                    if incremental and export_path is not None
+                    else None
+                ),
+            )
+        except InvoiceRenderError as e:
+            written = e.export_file_paths
+            failures = e.failures
 
-    invoice_parsed = [models.InvoiceFileParse(**i) for i in input_data if i]
+    for file_name in written:
+        results[invoice_properties[file_name]].invoices.append(file_name)
+    for file_name, reason in failures.items():
+        results[invoice_properties[file_name]].failures[file_name] = reason
 
-    return generate_invoices(
-        template_path=template_path, input_data=invoice_parsed, export_path=export_path
-    )
+    if ledger is not None:
+        written_names = set(written)
+        issued = {}
+        for invoice, file_name in zip(input_data, file_names):
+            if file_name in written_names:
+                issued.setdefault(invoice_properties[file_name], []).append(invoice)
+        for property_code, invoices in issued.items():
+            record_written_invoices(ledger, property_code, statement_date, invoices)
+
+    return results
 
 
 def get_binary_file_downloader_html(bin_file, file_label="File"):
@@ -493,27 +1694,27 @@ def get_binary_file_downloader_html(bin_file, file_label="File"):
     return href
 
 
-def user_download_invoice_zip(file_dir: str):
-    """Creates a Streamlit download button allowing user to download the composed invoices
+def zip_invoice_files(file_dir: str) -> BytesIO:
+    """Zips the composed invoices in file_dir into an in-memory archive
 
     Args:
         file_dir (str): local (container) directory containing the invoices
+
+    Returns:
+        BytesIO: zip archive, rewound to the start
     """
     zip_buffer = BytesIO()
 
-    with zipfile.ZipFile(zip_buffer, "w") as zip_file:
-        for filename in os.listdir(file_dir):
-            if filename.endswith(".xlsx"):
-                filepath = os.path.join(file_dir, filename)
-                zip_file.write(filepath, arcname=filename)
+    with instrumentation.stage("zip") as stage:
+        with zipfile.ZipFile(zip_buffer, "w") as zip_file:
+            for filename in os.listdir(file_dir):
+                if filename.endswith(".xlsx"):
+                    filepath = os.path.join(file_dir, filename)
+                    zip_file.write(filepath, arcname=filename)
+        stage["files"] = len(zip_file.filelist)
+        stage["bytes_written"] = zip_buffer.tell()
     zip_buffer.seek(0)
-    st.download_button(
-        label="Download All Reports",
-        data=zip_buffer,
-        file_name="all_reports.zip",
-        mime="application/zip",
-    )
-    zip_buffer.close()
+    return zip_buffer
 
 
 def clear_directory(file_dir: str):
@@ -533,21 +1734,69 @@ def clear_directory(file_dir: str):
             print(f"Failed to delete {file_path}. Reason: {e}")
 
 
-def display_existing_invoice(invoice_data: list[dict]) -> pd.DataFrame:
-    collection = []
-    for invoice in invoice_data:
-        details = invoice["details"]
-        collection.append(
-            {
-                "lot": invoice["lot_id"],
-                "account holder name": invoice["tenant_name"],
-                "rent": details["amt_rent"],
-                "storage": details["amt_storage"],
-                "water": details["amt_water"],
-                "other rent": details["amt_other_rent"],
-                "overdue": details["amt_overdue"],
-                "late fees": details["amt_late_fee"],
-                "total invoice due": invoice["amount_due"],
-            }
-        )
-    return round(pd.DataFrame(collection), 2)
+def session_workspace(output_path: str, session_id: str) -> str:
+    """Returns the directory of a session under output_path, creating it if needed
+
+    Touching the directory on every call keeps it from being removed by
+    remove_expired_workspaces while the session is in use.
+
+    Args:
+        output_path (str): local directory shared by all sessions
+        session_id (str): identifier of the session
+
+    Returns:
+        str: path of the session's directory, ending with a path separator
+    """
+    workspace = os.path.join(output_path, session_id) + os.sep
+    os.makedirs(workspace, exist_ok=True)
+    os.utime(workspace)
+    return workspace
+
+
+def remove_expired_workspaces(output_path: str, ttl_seconds: float) -> list[str]:
+    """Deletes the session directories under output_path unused for ttl_seconds
+
+    Args:
+        output_path (str): local directory shared by all sessions
+        ttl_seconds (float): time since a directory was last used before it expires
+
+    Returns:
+        list[str]: paths of the deleted directories
+    """
+    if not os.path.isdir(output_path):
+        return []
+
+    expired_before = time.time() - ttl_seconds
+    removed = []
+    for entry in os.scandir(output_path):
+        if (
+            entry.is_dir(follow_symlinks=False)
+            and entry.stat().st_mtime < expired_before
+        ):
+            shutil.rmtree(entry.path, ignore_errors=True)
+            removed.append(entry.path)
+    return removed
+
+
+def display_existing_invoice(
+    ledger: InvoiceLedger,
+    property_codes: list[str] | None = None,
+    start: date | None = None,
+    end: date | None = None,
+    lots: list[int] | None = None,
+) -> pd.DataFrame:
+    """Lists the amounts of the invoices recorded in the ledger
+
+    Args:
+        ledger (InvoiceLedger): ledger the generation runs recorded their invoices in
+        property_codes (list[str] | None, optional):
+            Properties to list. Defaults to all.
+        start (date | None, optional): first statement date to list
+        end (date | None, optional): last statement date to list
+        lots (list[int] | None, optional): lot numbers to list. Defaults to all.
+
+    Returns:
+        pd.DataFrame: one row per invoice, amounts rounded to cents
+    """
+    summary = ledger.summary(property_codes, start=start, end=end, lots=lots)
+    return round(summary.rename(columns=DISPLAY_COLUMNS), 2)
@@ -0,0 +1,258 @@
+import os
+import sqlite3
+from collections import Counter
+from contextlib import closing
+from datetime import date
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS water_readings (
+    watermeter_id INTEGER NOT NULL,
+    reading_date TEXT NOT NULL,
+    reading INTEGER NOT NULL,
+    lot_id,
+    inserted_at TEXT NOT NULL,
+    PRIMARY KEY (watermeter_id, reading_date)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS water_readings_by_date
+    ON water_readings (reading_date, watermeter_id);
+"""
+
+
+class WaterReadingStore:
+    """
+    Water meter readings of every ingested water report, kept in a SQLite file and
+    keyed by meter number and reading date, so that a month's report only needs the
+    current readings and the history of a meter does not mean re-reading old reports.
+
+    Each call opens its own connection rather than the store keeping one: the store
+    is created by the script run that submits a generation job, but read and written
+    on the JobQueue thread the job runs on, and a sqlite3 connection cannot be used
+    by a thread other than the one that opened it. Dates are stored as ISO strings,
+    which sort like the dates.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def add_readings(
+        self, readings: pd.DataFrame, inserted_at: datetime | None = None
+    ) -> tuple[int, int]:
+        """
+        Adds readings to the store. A reading already stored for the same meter and
+        date is replaced if its value differs, e.g. after a corrected report.
+
+        Args:
+            readings (pd.DataFrame):
+                "watermeter_id", "reading_date", "reading" and optionally "lot_id"
+                columns, one row per reading
+            inserted_at (datetime | None, optional):
+                Time the readings were recorded. Defaults to now.
+
+        Returns:
+            tuple[int, int]: number of readings added and of readings updated
+        """
+        inserted_at = (inserted_at or datetime.now()).isoformat(timespec="seconds")
+        lot_ids = readings["lot_id"] if "lot_id" in readings else [None] * len(readings)
+        rows = [
+            (int(meter), reading_date.isoformat(), int(reading), lot_id, inserted_at)
+            for meter, reading_date, reading, lot_id in zip(
+                readings["watermeter_id"],
+                readings["reading_date"],
+                readings["reading"],
+                lot_ids,
+            )
+        ]
+
+        with closing(self._connect()) as conn, conn:
+            added = conn.executemany(
+                "INSERT OR IGNORE INTO water_readings VALUES (?, ?, ?, ?, ?)", rows
+            ).rowcount
+            updated = conn.executemany(
+                "UPDATE water_readings SET reading = ?3, lot_id = ?4, inserted_at = ?5"
+                " WHERE watermeter_id = ?1 AND reading_date = ?2 AND reading != ?3",
+                rows,
+            ).rowcount
+        return added, updated
+
+    def ingest_report(self, report: pd.DataFrame) -> tuple[int, int]:
+        """
+        Adds the readings of a water report to the store: the current readings and,
+        if the report has a previous reading date, the previous readings. Rows whose
+        meter number or reading is missing or not a whole number are skipped.
+
+        Args:
+            report (pd.DataFrame):
+                Water usage report as returned by
+                utils.ingest_water_meter_readings
+
+        Returns:
+            tuple[int, int]: number of readings added and of readings updated
+        """
+        meters = pd.to_numeric(report["Meter #"], errors="coerce")
+        lot_ids = [
+            None if np.isnan(lot) else int(lot)
+            for lot in pd.to_numeric(report.index, errors="coerce")
+        ]
+
+        frames = []
+        for column in (2, 3):
+            reading_date = report.columns[column]
+            if not isinstance(reading_date, date):
+                continue
+            values = pd.to_numeric(report.iloc[:, column], errors="coerce")
+            valid = (
+                np.isfinite(meters)
+                & (meters == np.floor(meters))
+                & np.isfinite(values)
+                & (values == np.floor(values))
+            ).to_numpy()
+            frames.append(
+                pd.DataFrame(
+                    {
+                        "watermeter_id": meters[valid],
+                        "reading_date": reading_date,
+                        "reading": values[valid],
+                        "lot_id": [lot for lot, v in zip(lot_ids, valid) if v],
+                    }
+                )
+            )
+        if not frames:
+            return 0, 0
+        return self.add_readings(pd.concat(frames, ignore_index=True))
+
+    def latest_readings(self, watermeter_ids, before: date) -> pd.DataFrame:
+        """
+        Looks up the last reading of each meter taken before a date. Each lookup is a
+        seek on the primary key, so the cost does not grow with the stored history.
+
+        Args:
+            watermeter_ids: meter numbers to look up
+            before (date): readings taken on or after this date are ignored
+
+        Returns:
+            pd.DataFrame: "reading_date" and "reading" indexed by "watermeter_id",
+            without the meters that have no earlier reading
+        """
+        with closing(self._connect()) as conn:
+            _create_meters_table(conn, watermeter_ids)
+            rows = conn.execute(
+                """
+                SELECT r.watermeter_id, r.reading_date, r.reading
+                FROM meters m
+                JOIN water_readings r
+                    ON r.watermeter_id = m.watermeter_id
+                    AND r.reading_date = (
+                        SELECT MAX(reading_date) FROM water_readings
+                        WHERE watermeter_id = m.watermeter_id AND reading_date < ?
+                    )
+                """,
+                (before.isoformat(),),
+            ).fetchall()
+        return _readings_frame(rows, ["watermeter_id", "reading_date", "reading"])
+
+    def history(
+        self,
+        watermeter_ids=None,
+        start: date | None = None,
+        end: date | None = None,
+    ) -> pd.DataFrame:
+        """
+        Stored readings ordered by meter and date.
+
+        Args:
+            watermeter_ids (optional): meter numbers to include. Defaults to all.
+            start (date | None, optional): first reading date to include
+            end (date | None, optional): last reading date to include
+
+        Returns:
+            pd.DataFrame: "watermeter_id", "reading_date", "reading" and "lot_id"
+            columns, one row per reading
+        """
+        conditions = []
+        params = []
+        if start is not None:
+            conditions.append("reading_date >= ?")
+            params.append(start.isoformat())
+        if end is not None:
+            conditions.append("reading_date <= ?")
+            params.append(end.isoformat())
+
+        with closing(self._connect()) as conn:
+            if watermeter_ids is not None:
+                _create_meters_table(conn, watermeter_ids)
+                conditions.append("watermeter_id IN (SELECT watermeter_id FROM meters)")
+            where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+            rows = conn.execute(
+                "SELECT watermeter_id, reading_date, reading, lot_id"
+                f" FROM water_readings {where} ORDER BY watermeter_id, reading_date",
+                params,
+            ).fetchall()
+        return _readings_frame(
+            rows, ["watermeter_id", "reading_date", "reading", "lot_id"], index=None
+        )
+
+    def fill_previous_readings(self, report: pd.DataFrame) -> tuple[pd.DataFrame, int]:
+        """
+        Completes a water report with the stored readings: every meter without a
+        previous reading gets the last reading stored before the report's current
+        date. A report without a previous reading date takes the date most of those
+        readings were taken on, as the invoices list one previous date per report.
+
+        Args:
+            report (pd.DataFrame):
+                Water usage report as returned by
+                utils.ingest_water_meter_readings
+
+        Returns:
+            tuple[pd.DataFrame, int]: the completed report and the number of
+            readings filled in
+        """
+        current_date = report.columns[2]
+        previous_date = report.columns[3]
+        meters = pd.to_numeric(report["Meter #"], errors="coerce")
+        previous = pd.to_numeric(report.iloc[:, 3], errors="coerce")
+        missing = (previous.isna() & meters.notna()).to_numpy()
+
+        latest = self.latest_readings(meters[missing].unique(), before=current_date)
+        filled = meters[missing].map(latest["reading"])
+        if not isinstance(previous_date, date):
+            if latest.empty:
+                raise ValueError(
+                    "The water report has no previous readings and none are stored "
+                    f"before {current_date}"
+                )
+            dates = Counter(latest["reading_date"])
+            previous_date = dates.most_common(1)[0][0]
+
+        previous = report.iloc[:, 3].astype(object)
+        previous[missing] = filled.astype(object).where(filled.notna(), "").to_numpy()
+        report = report.copy()
+        report.isetitem(3, previous)
+        report.columns = [*report.columns[:3], previous_date, *report.columns[4:]]
+        return report, int(filled.notna().sum())
+
+
+def _create_meters_table(conn: sqlite3.Connection, watermeter_ids):
+    """Puts the meter numbers to look up in a temporary table to join against"""
+    conn.execute("CREATE TEMP TABLE meters (watermeter_id INTEGER PRIMARY KEY)")
+    conn.executemany(
+        "INSERT OR IGNORE INTO meters VALUES (?)", ((int(m),) for m in watermeter_ids)
+    )
+
+
+def _readings_frame(rows: list, columns: list[str], index="watermeter_id"):
+    df = pd.DataFrame(rows, columns=columns)
+    df["reading_date"] = [date.fromisoformat(d) for d in df["reading_date"]]
+    return df.set_index(index) if index else df
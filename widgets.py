@@ -0,0 +1,266 @@
+"""Streamlit widgets of the invoicing app"""
+
+from datetime import date
+from io import BytesIO
+
+import pandas as pd
+import streamlit as st
+from dateutil.relativedelta import relativedelta
+
+from invoice_ledger import InvoiceLedger
+from jobs import InvoiceJob
+from jobs import JobQueue
+from utils import display_existing_invoice
+from utils import read_book_lots
+from utils import zip_invoice_files
+
+
+def statement_date_widget() -> date:
+    """
+    Sets the statement date for the session that the user is working on. The function
+    creates Streamlit number input widgets to take user input for a year and month to
+    return the first of the selected month as date object.
+    """
+    st.sidebar.write("Select the statement date to work on:")
+    year = st.sidebar.number_input(
+        label="Year",
+        min_value=2020,
+        max_value=2100,
+        value=(date.today() + relativedelta(months=1)).year,
+    )
+    month = st.sidebar.number_input(
+        label="Month",
+        min_value=1,
+        max_value=12,
+        value=(date.today() + relativedelta(months=1)).month,
+    )
+    selected_date = date(year, month, 1)
+
+    if st.session_state.statement_date != selected_date:
+        st.session_state.statement_date = selected_date
+
+    return selected_date
+
+
+def properties_widget(properties: list[dict]) -> dict:
+    """Returns a widget that allows user to set the session property to work with
+
+    Args:
+        properties (list[dict]): List of properties available in the database
+
+    Returns:
+        dict: Dict form of a property object
+    """
+    st.session_state.prop = st.sidebar.selectbox(
+        "Select the invoice configuration",
+        options=properties,
+        format_func=lambda x: x["property_code"],
+    )
+
+    return st.session_state.prop
+
+
+def run_metrics_widget(run: dict | None, profile_summary: str | None = None):
+    """Shows the timings and counters of the last generation run in the side bar
+
+    Args:
+        run (dict | None): RunMetrics.to_dict() of the last run, if any
+        profile_summary (str | None, optional): profiler output of the last run
+    """
+    if not run:
+        return
+
+    with st.sidebar.expander("Last run metrics"):
+        st.write(f"Total: {run['seconds']:.2f} s")
+        if run["error"]:
+            st.write(f"Error: {run['error']}")
+        st.dataframe(
+            pd.DataFrame.from_dict(run["stages"], orient="index").round(3),
+            use_container_width=True,
+        )
+        st.json(run["counters"])
+        if profile_summary:
+            st.code(profile_summary, language=None)
+
+
+def user_download_invoice_zip(
+    file_dir: str | None = None, zip_buffer: BytesIO | None = None
+):
+    """Creates a Streamlit download button allowing user to download the composed invoices
+
+    Args:
+        file_dir (str | None, optional):
+            local (container) directory containing the invoices. Defaults to None.
+        zip_buffer (BytesIO | None, optional):
+            Already built zip archive of the invoices, used instead of zipping file_dir.
+            Defaults to None.
+    """
+    if zip_buffer is None:
+        zip_buffer = zip_invoice_files(file_dir)
+    zip_buffer.seek(0)
+    st.download_button(
+        label="Download All Reports",
+        data=zip_buffer,
+        file_name="all_reports.zip",
+        mime="application/zip",
+    )
+    zip_buffer.close()
+
+
+def user_download_invoices(zip_buffer: BytesIO, workbook: BytesIO | None = None):
+    """
+    Creates the download button of the invoices: the workbook with a sheet per invoice
+    if one was generated, the zip archive otherwise
+    """
+    if workbook is None:
+        user_download_invoice_zip(zip_buffer=zip_buffer)
+        return
+    workbook.seek(0)
+    st.download_button(
+        label="Download All Reports",
+        data=workbook,
+        file_name="all_reports.xlsx",
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    )
+    workbook.close()
+    zip_buffer.close()
+
+
+@st.fragment(run_every=0.5)
+def generation_job_widget(job: InvoiceJob, queue: JobQueue):
+    """
+    Shows the progress of a generation job, refreshing on its own without rerunning
+    the rest of the page, and reruns the page once the job has finished
+
+    Args:
+        job (InvoiceJob): unfinished job of the session
+        queue (JobQueue): queue the job was submitted to
+    """
+    if job.done:
+        st.rerun()
+    position = queue.position(job)
+    done, total = job.progress
+    if position:
+        st.progress(0.0, text=f"Waiting for {position} earlier run(s) to finish")
+    elif not total:
+        st.progress(0.0, text="Reading the uploaded files")
+    else:
+        st.progress(done / total, text=f"Rendered {done} of {total} invoice(s)")
+
+
+def lots_widget(
+    book: BytesIO, sheet_name: str, excel_engine: str | None = None
+) -> list[int] | None:
+    """Lets the user pick a subset of the lots of the worksheet to invoice
+
+    The lot column of the worksheet is only read once the user chooses to invoice
+    some lots, so the sheet is not parsed before the invoices are generated.
+
+    Args:
+        book (BytesIO): uploaded bookkeeping file
+        sheet_name (str): worksheet selected for invoicing
+        excel_engine (str | None, optional): pd.read_excel engine to read with
+
+    Returns:
+        list[int] | None: the selected lot numbers, or None to invoice every lot
+    """
+    if not st.checkbox("Only invoice some of the lots"):
+        return None
+    try:
+        lot_numbers = read_book_lots(book, sheet_name, engine=excel_engine)
+    except Exception as e:
+        st.error(f"Could not read the lots of the worksheet: {e}")
+        return None
+
+    lots = st.multiselect(
+        "Only invoice these lots (leave empty to invoice every lot):",
+        options=lot_numbers,
+    )
+    return lots or None
+
+
+def property_batch_widget(properties: list[dict], sheet_names: list[str]) -> dict:
+    """Lets the user pick the worksheet and water report of every property
+
+    Args:
+        properties (list[dict]): List of properties available in the database
+        sheet_names (list[str]): worksheets of the uploaded bookkeeping file
+
+    Returns:
+        dict: inputs of each property code, as taken by generate_property_batch_zip
+        (without the book)
+    """
+    batch = {}
+    for prop in properties:
+        property_code = prop["property_code"]
+        sheet_column, water_column = st.columns(2)
+        sheet_name = sheet_column.selectbox(
+            f"{property_code} worksheet",
+            options=sheet_names,
+            index=len(sheet_names) - 1 if sheet_names else None,
+            key=f"batch_sheet_{property_code}",
+        )
+        waters = water_column.file_uploader(
+            f"{property_code} water report (.xlsx)",
+            type=["xlsx"],
+            key=f"batch_water_{property_code}",
+        )
+        batch[property_code] = {"sheet_name": sheet_name, "waters": waters}
+    return batch
+
+
+def property_batch_results_widget(results: dict):
+    """Shows the invoices generated and the failures of each property of a batch run
+
+    Args:
+        results (dict): PropertyBatchResult of each property code
+    """
+    st.dataframe(
+        pd.DataFrame(
+            [
+                {
+                    "property": code,
+                    "invoices": len(result.invoices),
+                    "failed invoices": ", ".join(result.failures),
+                    "error": result.error or "",
+                }
+                for code, result in results.items()
+            ]
+        ),
+        hide_index=True,
+        use_container_width=True,
+    )
+
+
+def invoice_ledger_widget(ledger: InvoiceLedger, properties: list[dict] | None):
+    """Lists the invoices recorded in the ledger, with their totals per month
+
+    Args:
+        ledger (InvoiceLedger): ledger the generation runs recorded their invoices in
+        properties (list[dict] | None): properties available in the database
+    """
+    with st.expander("Invoice ledger"):
+        property_codes = st.multiselect(
+            "Properties (leave empty for all):",
+            options=[p["property_code"] for p in properties or []],
+            key="ledger_properties",
+        )
+        today = date.today()
+        dates = st.date_input(
+            "Statement dates",
+            value=(today.replace(day=1) - relativedelta(years=1), today),
+            key="ledger_dates",
+        )
+        # only the start date is set while the range is being picked
+        start, end = (*dates, None)[:2]
+        property_codes = property_codes or None
+        st.dataframe(
+            round(ledger.totals(property_codes, start=start, end=end), 2),
+            use_container_width=True,
+            hide_index=True,
+        )
+        st.dataframe(
+            display_existing_invoice(ledger, property_codes, start=start, end=end),
+            use_container_width=True,
+            hide_index=True,
+        )